@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Materialized observed-actuals series for the dashboard bars.
+# Forecast files repeat the observed history up to their model date; for every
+# (location, metric, model_name, date) the projection_actuals table keeps the value from the newest
+# model date that covers it, plus rolling means for the common smoothing windows.
+# The scraper upserts it for each model_date it loads.
+#
+# usage: python actuals.py    (rebuild the table from every model_date in projections)
+
+import io
+
+import pandas as pd
+from sqlalchemy import create_engine
+
+from catalog import numeric_columns
+from config import app_config
+
+actuals_table = 'projection_actuals'
+actual_keys = ['location_name', 'metric', 'model_name', 'date']
+rolling_windows = [3, 7, 14, 28]
+
+def actual_metrics(columns):
+    '''
+    metric columns with observed history (deaths and confirmed cases)
+    '''
+    return [c for c in numeric_columns(columns) if 'confirmed' in c or 'dea' in c]
+
+def observed_rows(df):
+    '''
+    df: projections rows for one or more model dates
+    returns: long frame of actual_keys + value, source_model_date for rows with date <= model_date,
+        taking each value from the newest model date
+    '''
+    metrics = actual_metrics(df.columns)
+    df = df[df['date'] <= df['model_date']]
+    keys = ['location_name', 'model_name', 'date', 'model_date']
+    long = df[keys + metrics].melt(id_vars=keys, value_vars=metrics, var_name='metric', value_name='value')
+    long = long.dropna(subset=['value']).rename(columns={'model_date': 'source_model_date'})
+    for c in ['location_name', 'model_name']:
+        long[c] = long[c].astype('str')
+    long = long.sort_values('source_model_date').drop_duplicates(actual_keys, keep='last')
+    return long[actual_keys + ['value', 'source_model_date']]
+
+def create_actuals_sql():
+    rolling_cols = ', '.join(f'rolling_{w} real' for w in rolling_windows)
+    return f'''
+        CREATE TABLE IF NOT EXISTS {actuals_table} (
+            location_name text, metric text, model_name text, date timestamp,
+            value real, source_model_date timestamp, {rolling_cols},
+            PRIMARY KEY (location_name, metric, model_name, date)
+        )'''
+
+def upsert_actuals(engine, df, chunksize=100000):
+    '''
+    merge the observed rows of df into the actuals table (older model dates never overwrite newer ones)
+    and recompute the rolling means of the series it touched
+    rows are streamed with COPY into a temporary staging table and merged with one INSERT ... ON CONFLICT,
+    in key order so concurrent merges lock rows in the same order
+    returns: number of observed rows in df
+    '''
+    rows = observed_rows(df)
+    cols = actual_keys + ['value', 'source_model_date']
+    col_list = ', '.join(cols)
+    key_list = ', '.join(actual_keys)
+
+    #rolling means over the previous w rows, null until a full window is available (like pandas rolling)
+    windows = ', '.join(
+        f'CASE WHEN COUNT(value) OVER w{w} = {w} THEN AVG(value) OVER w{w} END AS rolling_{w}' for w in rolling_windows)
+    window_defs = ', '.join(
+        f'w{w} AS (PARTITION BY location_name, metric, model_name ORDER BY date ROWS BETWEEN {w - 1} PRECEDING AND CURRENT ROW)'
+        for w in rolling_windows)
+
+    conn = engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(create_actuals_sql())
+        if rows.empty:
+            conn.commit()
+            return 0
+
+        cursor.execute(f'CREATE TEMP TABLE {actuals_table}_staging (LIKE {actuals_table} INCLUDING DEFAULTS) ON COMMIT DROP')
+        for start in range(0, len(rows), chunksize):
+            buf = io.StringIO()
+            rows.iloc[start:start + chunksize].to_csv(buf, index=False, header=False, date_format='%Y-%m-%d %H:%M:%S')
+            buf.seek(0)
+            cursor.copy_expert(f"COPY {actuals_table}_staging ({col_list}) FROM STDIN WITH (FORMAT csv, NULL '')", buf)
+
+        cursor.execute(f'''
+            INSERT INTO {actuals_table} ({col_list})
+            SELECT {col_list} FROM {actuals_table}_staging ORDER BY {key_list}
+            ON CONFLICT ({key_list}) DO UPDATE SET
+            value = excluded.value, source_model_date = excluded.source_model_date
+            WHERE {actuals_table}.source_model_date <= excluded.source_model_date
+        ''')
+
+        since = pd.Timestamp(rows['date'].min())
+        window_start = (since - pd.Timedelta(days=max(rolling_windows) - 1)).to_pydatetime()
+        since = since.to_pydatetime()
+        for model_name in sorted(rows['model_name'].unique()):
+            cursor.execute(f'''
+                UPDATE {actuals_table} AS a SET {', '.join(f'rolling_{w} = r.rolling_{w}' for w in rolling_windows)}
+                FROM (
+                    SELECT location_name, metric, model_name, date, {windows}
+                    FROM {actuals_table} WHERE model_name = %(model_name)s AND date >= %(window_start)s
+                    WINDOW {window_defs}
+                ) r
+                WHERE a.location_name = r.location_name AND a.metric = r.metric AND a.model_name = r.model_name
+                AND a.date = r.date AND a.date >= %(since)s
+            ''', {'model_name': model_name, 'since': since, 'window_start': window_start})
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    return len(rows)
+
+def read_actuals(engine, location, metric, model_name):
+    '''
+    returns: frame with date, value and rolling_{w} columns ordered by date,
+        or None if the actuals table has not been built
+    '''
+    query = f'''
+    SELECT date, value, {', '.join(f'rolling_{w}' for w in rolling_windows)}
+    FROM {actuals_table}
+    WHERE location_name = %s AND metric = %s AND model_name = %s
+    ORDER BY date
+    '''
+    try:
+        return pd.read_sql_query(query, engine, params=(location, metric, model_name), parse_dates=['date'])
+    except Exception as e:
+        print(f'actuals table unavailable: {e}')
+        return None
+
+def rebuild_actuals(engine, table_name='projections'):
+    '''
+    refill the actuals table from every model_date in table_name, oldest first
+    '''
+    model_dates = pd.read_sql_query(f'SELECT DISTINCT model_date FROM {table_name} ORDER BY model_date', engine).model_date
+    total = 0
+    for md in model_dates:
+        df = pd.read_sql_query(f'SELECT * FROM {table_name} WHERE model_date = %s', engine, params=(md,), parse_dates=['date', 'model_date'])
+        total += upsert_actuals(engine, df)
+        print(f'model_date: {md}, observed rows: {total}')
+    return total
+
+if __name__ == "__main__":
+    engine = create_engine(app_config['sqlalchemy_database_uri'])
+    rebuild_actuals(engine, app_config['database_name'])
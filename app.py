@@ -4,6 +4,7 @@
 import pandas as pd
 import numpy as np
 import os
+import base64
 from datetime import datetime, timedelta
 from sqlalchemy import create_engine
 
@@ -11,51 +12,64 @@ import dash
 import dash_core_components as dcc
 import dash_bootstrap_components as dbc
 import dash_html_components as html
-from dash.dependencies import Input, Output, State
+from dash.dependencies import Input, Output, State, ClientsideFunction
+from dash.exceptions import PreventUpdate
+from flask import jsonify
 from flask_talisman import Talisman
 
 import plotly.graph_objects as go
 import plotly.express as px
+import plotly.io as pio
 
 from region_abbreviations import us_state_abbrev
 from more_info import more_info_alert
 from column_translater import column_translator
 from plot_option_data import csv_dtypes, table_dtypes
 from config import app_config, plotly_config
-from helper import flatten
+from filter_cache import FilterCache
+from downsample import downsample_series
+from peak_summary import read_peaks, version_peaks, peak_columns
+from actuals import read_actuals, rolling_windows
+from projections_cube import CubeReader
+from queries import filter_query, filter_params
+from catalog import load_catalog, catalog_max_model_date
 
 # make sqlite connection
 engine = create_engine(app_config['sqlalchemy_database_uri'])
 table_name = app_config['database_name']
 
+# locations, metrics and model_date bounds come from the catalog maintained by the scraper,
+# so booting a worker doesn't scan the projections table
+catalog = load_catalog(engine, snapshot_path=app_config['catalog_snapshot'])
+
 def unique_location_names():
-    df = pd.read_sql_query("SELECT DISTINCT location_name FROM projections", engine)
-    return list(flatten(df.values))
+    return catalog['locations']
 
 def min_model_date():
-    df = pd.read_sql_query("SELECT MIN(model_date) FROM projections", engine)
-    return df.iloc[0,0]
+    return pd.Timestamp(catalog['min_model_date'])
 
 def metric_labels():
-    df = pd.read_sql_query("SELECT * FROM projections limit 10", engine)
-    df = df.astype(dict((k, table_dtypes[k]) for k in df.columns if k in table_dtypes))
-    return sorted([{"label": column_translator[col], "value": col} for col in df.select_dtypes(include=np.number).columns.sort_values().tolist() ], key=lambda k: k['label'])
+    return sorted([{"label": column_translator[col], "value": col} for col in catalog['metrics'] if col in column_translator], key=lambda k: k['label'])
 
-def filter_df(model, location, metric, start_date, end_date):
+# optional memory-mapped cube, every worker maps the same file (shared through the page cache), see projections_cube.py
+cube_reader = CubeReader(app_config['cube_dir']) if app_config['cube_dir'] else None
 
-    filter_query = '''
-    SELECT location_name, date, {3}, model_name, model_date, model_version, location_abbr 
-    FROM {0} 
-    WHERE {0}.location_name = {1} 
-    AND {0}.model_name IN ({2}) 
-    AND {0}.model_date BETWEEN {1} 
-    AND {1} AND {0}.date > '2020-02-15'  
-    ORDER BY {0}.date
-    '''
-    filter_query = filter_query.format(table_name,'%s', ','.join(['%s'] * len(model)), metric)
+def data_version():
+    #in cube mode results also change when a new cube generation is swapped in; metrics outside
+    #the cube, peaks and actuals still come from the database, so its newest model_date counts too
+    if cube_reader is not None and cube_reader.generation() is not None:
+        return (cube_reader.generation(), catalog_max_model_date(engine))
+    return catalog_max_model_date(engine)
 
-    dff = pd.read_sql_query(filter_query,engine, params=tuple(flatten((location, model, start_date, end_date))),
-                            parse_dates=['model_date', 'date'])
+def load_filter_df(model, location, metric, start_date, end_date):
+
+    cube = cube_reader.current() if cube_reader is not None else None
+    if cube is not None and metric in cube:
+        dff = cube.filter_df(model, location, metric, start_date, end_date)
+    else:
+        dff = pd.read_sql_query(filter_query(table_name, metric, len(model)), engine,
+                                params=filter_params(model, location, start_date, end_date),
+                                parse_dates=['model_date', 'date'])
 
 
     # there's probably a better way to do this instead of hard-coding the types
@@ -70,6 +84,13 @@ def filter_df(model, location, metric, start_date, end_date):
 
     return dff
 
+# results are cached per worker until a new model_date is loaded (or a new cube is built)
+filter_cache = FilterCache(data_version, maxsize=64, check_interval=60)
+
+def filter_df(model, location, metric, start_date, end_date):
+    key = (tuple(sorted(model)), location, metric, start_date, end_date)
+    return filter_cache.get(key, lambda: load_filter_df(model, location, metric, start_date, end_date))
+
 #initialize app
 app = dash.Dash(
     __name__, 
@@ -88,6 +109,10 @@ title = 'COVID Projections Tracker'
 app.title = title
 server = app.server #need this for heroku - gunicorn deploy
 
+@server.route('/_filter_cache')
+def filter_cache_stats():
+    return jsonify(filter_cache.stats())
+
 # This forces https for the site
 if not app_config['debug']:
     Talisman(app.server, content_security_policy=None)
@@ -112,6 +137,23 @@ excluded_colorscales = ['plotly3','gray','haline','ice','solar','thermal']
 named_colorscales = [s for s in px.colors.named_colorscales() if s not in excluded_colorscales]
 style_lists = [[style,getattr(px.colors.sequential,style)] for style in dir(px.colors.sequential) if style.lower() in named_colorscales and len(getattr(px.colors.sequential,style)) >= 12]
 
+# above these sizes the primary graph is drawn with WebGL traces
+webgl_trace_threshold = 30
+webgl_point_threshold = 5000
+# longer series are downsampled to this many points
+max_points_per_trace = 400
+
+def render_config():
+    '''
+    static data for the clientside renderer: colour scales and the plotly template
+    '''
+    return {
+        'color_scales': dict(style_lists),
+        'template': pio.templates['ggplot2'].to_plotly_json(),
+        'webgl_trace_threshold': webgl_trace_threshold,
+        'webgl_point_threshold': webgl_point_threshold,
+    }
+
 # get minimum model date
 min_date = min_model_date()
 
@@ -334,6 +376,8 @@ app.layout = dbc.Container(
             ],
             align="center",
         ),
+        dcc.Store(id="projections-store"),
+        dcc.Store(id="render-config", data=render_config() if app_config['clientside_rendering'] else None),
         html.Hr(),
         dbc.Row(id='stat-cards'),
         html.Hr(),
@@ -406,24 +450,41 @@ def toggle_collapse(n, is_open):
     return is_open
 
 
-def build_cards(dff, metric, model):
+def filter_peaks(model, location, metric, start_date, end_date):
+    key = ('peaks', tuple(sorted(model)), location, metric, start_date, end_date)
+    def load():
+        peaks = read_peaks(engine, model, location, metric, start_date, end_date)
+        return peaks if peaks is not None else pd.DataFrame(columns=peak_columns)
+    return filter_cache.get(key, load)
+
+def filter_actuals(location, metric, model_name):
+    key = ('actuals', location, metric, model_name)
+    def load():
+        actuals = read_actuals(engine, location, metric, model_name)
+        return actuals if actuals is not None else pd.DataFrame(columns=['date', 'value'])
+    return filter_cache.get(key, load)
+
+def build_cards(peaks, metric):
+    '''
+    peaks: one row per model version with its peak_value (see peak_summary.py)
+    '''
 
     metric_name = column_translator[metric]
 
     #latest data
-    latest_version = dff.model_date.max()
+    latest_version = peaks.model_date.max()
     #TODO: Maybe add cards for latest versions of LANL and IHME
-    dff_latest = dff[(dff.model_date == latest_version)]
-    proj_latest = dff_latest[metric].max()
-    proj_latest_model = dff_latest['model_name'].unique()[0]+' - '+dff_latest['model_version'].unique()[0]
+    peaks_latest = peaks[(peaks.model_date == latest_version)]
+    proj_latest = peaks_latest['peak_value'].max()
+    proj_latest_model = peaks_latest['model_name'].iloc[0]+' - '+peaks_latest['model_version'].iloc[0]
 
     #historical max and mins
-    version_max = dff.groupby(['model_name','model_version'])[metric].max()
+    version_max = peaks.set_index(['model_name','model_version'])['peak_value']
     proj_max = np.max(version_max)
     proj_min = np.min(version_max)
     #model labels
-    proj_max_model = ' - '.join(version_max.index[np.argmax(version_max)])
-    proj_min_model = ' - '.join(version_max.index[np.argmin(version_max)])
+    proj_max_model = ' - '.join(version_max.index[np.argmax(version_max.values)])
+    proj_min_model = ' - '.join(version_max.index[np.argmin(version_max.values)])
     
     
     cards = [
@@ -477,33 +538,169 @@ def build_cards(dff, metric, model):
     return cards
 
 
+epoch = pd.Timestamp('1970-01-01')
+
+def epoch_days(dates):
+    return ((dates - epoch) // pd.Timedelta(days=1)).astype('int64')
+
+def encode_float32(values):
+    return base64.b64encode(np.asarray(values, dtype='<f4').tobytes()).decode('ascii')
+
+def decode_float32(b64):
+    return np.frombuffer(base64.b64decode(b64), dtype='<f4')
+
+def encode_store(dff, location, metric, actuals=None):
+    '''
+    compact column-oriented payload of the filtered frame for the projections dcc.Store
+    model labels are dictionary encoded: each row holds an index into labels, and the model name,
+    version and model date are stored once per label. dates are days since 1970-01-01 and
+    metric values are little-endian float32, base64 encoded
+    actuals: optional observed series from the actuals table (see actuals.py), encoded the same way
+    '''
+    labels = dff['model_label'].astype('category')
+    meta = dff.drop_duplicates('model_label').set_index('model_label').reindex(labels.cat.categories)
+
+    if actuals is not None and not actuals.empty:
+        actuals = {
+            'day': epoch_days(actuals['date']).tolist(),
+            'value': encode_float32(actuals['value']),
+            'rolling': {str(w): encode_float32(actuals[f'rolling_{w}']) for w in rolling_windows},
+        }
+    else:
+        actuals = None
+
+    return {
+        'location': location,
+        'metric': metric,
+        'metric_label': column_translator[metric],
+        'actuals': actuals,
+        'title': f"{' & '.join(dff.model_name.unique())} - {location} - {column_translator[metric]}",
+        'labels': labels.cat.categories.tolist(),
+        'label_model_name': meta['model_name'].astype('str').tolist(),
+        'label_model_version': meta['model_version'].astype('str').tolist(),
+        'label_model_date': epoch_days(meta['model_date']).tolist(),
+        'label': labels.cat.codes.astype('int64').tolist(),
+        'day': epoch_days(dff['date']).tolist(),
+        'value': encode_float32(dff[metric]),
+    }
+
+def decode_store(data):
+    '''
+    returns: the frame encoded by encode_store, one row per (model_label, date)
+    '''
+    codes = np.array(data['label'], dtype='int64')
+    dff = pd.DataFrame({
+        'date': epoch + pd.to_timedelta(np.array(data['day'], dtype='int64'), unit='D'),
+        'model_date': epoch + pd.to_timedelta(np.array(data['label_model_date'], dtype='int64')[codes], unit='D'),
+        'model_name': np.array(data['label_model_name'], dtype=object)[codes],
+        'model_version': np.array(data['label_model_version'], dtype=object)[codes],
+        'model_label': np.array(data['labels'], dtype=object)[codes],
+        data['metric']: decode_float32(data['value']),
+    })
+    return dff
+
+def decode_actuals(data):
+    '''
+    returns: the actuals series encoded by encode_store (date, metric and rolling_{w} columns), or None
+    '''
+    actuals = data.get('actuals')
+    if actuals is None:
+        return None
+    act_dff = pd.DataFrame({
+        'date': epoch + pd.to_timedelta(np.array(actuals['day'], dtype='int64'), unit='D'),
+        data['metric']: decode_float32(actuals['value']),
+    })
+    for w, values in actuals['rolling'].items():
+        act_dff[f'rolling_{w}'] = decode_float32(values)
+    return act_dff
+
+
+
 @app.callback(
-    [Output("primary-graph", "figure"), Output("stat-cards", "children")],
+    [Output("projections-store", "data"), Output("stat-cards", "children")],
     [
         Input("model-dropdown", "value"),
         Input("location-dropdown", "value"),
         Input("metric-dropdown", "value"),
         Input("model-date-picker", "start_date"),
         Input("model-date-picker", "end_date"),
-        Input("log-scale-toggle", "value"),
-        Input("smoothed-actual-values-toggle", "value"),
-        Input("window_size", "value"),
-        Input("actual-values-toggle", "value"),
-        Input("ihme-color-dropdown", "value"),
-        Input("lanl-color-dropdown", "value")
     ],
-
 )
-def make_primary_graph(model, location, metric, start_date, end_date, log_scale, smoothed, window_size, actual_values, color_scale_ihme, color_scale_lanl):
-    '''Callback for the primary historical projections line chart
+def fetch_projections(model, location, metric, start_date, end_date):
+    '''Callback that queries the projections for the selected filters
+    only this callback touches the database, the graph is re-rendered from the store
     '''
     dff = filter_df(model, location, metric, start_date, end_date)
 
-    cards = build_cards(dff, metric, model)
+    # observed values for the bars come from the actuals table, preferring LANL like the derived series did
+    actuals = None
+    if 'confirmed' in metric or 'dea' in metric:
+        actuals = filter_actuals(location, metric, 'LANL' if 'LANL' in model else 'IHME')
+
+    # stat cards come from the peak summary table, falling back to the fetched rows until it is built
+    peaks = filter_peaks(model, location, metric, start_date, end_date)
+    if peaks.empty:
+        peaks = version_peaks(dff, [metric])
+    cards = build_cards(peaks, metric)
+
+    return encode_store(dff, location, metric, actuals), cards
+
+
+graph_inputs = [
+    Input("projections-store", "data"),
+    Input("log-scale-toggle", "value"),
+    Input("smoothed-actual-values-toggle", "value"),
+    Input("window_size", "value"),
+    Input("actual-values-toggle", "value"),
+    Input("ihme-color-dropdown", "value"),
+    Input("lanl-color-dropdown", "value"),
+]
+
+def relayout_x_range(relayout_data):
+    '''
+    returns: (start, end) of the zoomed x-axis from the graph's relayoutData, or None for the full range
+    '''
+    if not relayout_data:
+        return None
+    if 'xaxis.range[0]' in relayout_data and 'xaxis.range[1]' in relayout_data:
+        return relayout_data['xaxis.range[0]'], relayout_data['xaxis.range[1]']
+    if 'xaxis.range' in relayout_data:
+        return tuple(relayout_data['xaxis.range'])
+    return None
+
+def reduce_lines(line_dff, metric, relayout_data):
+    '''
+    bound the size of the line traces: series longer than max_points_per_trace are LTTB downsampled
+    within the visible x-range, and figures with many traces or points are drawn with WebGL
+    returns: (frame to plot, plotly express render_mode)
+    '''
+    if len(line_dff) and line_dff.groupby('model_label').size().max() > max_points_per_trace:
+        line_dff = downsample_series(line_dff, 'model_label', 'date', metric, max_points_per_trace,
+                                     x_range=relayout_x_range(relayout_data))
+    webgl = line_dff.model_label.nunique() > webgl_trace_threshold or len(line_dff) > webgl_point_threshold
+    return line_dff, ('webgl' if webgl else 'svg')
+
+def make_primary_graph(data, log_scale, smoothed, window_size, actual_values, color_scale_ihme, color_scale_lanl, relayout_data):
+    '''Callback for the primary historical projections line chart
+    presentation controls only re-render the stored data, they never re-run the query
+    zooming only re-renders when series were downsampled, to refill the new x-range
+    '''
+    if data is None:
+        raise PreventUpdate
 
-    model_title = ' & '.join(dff.model_name.unique())
+    metric = data['metric']
+    dff = decode_store(data)
 
-    plot_title = f'{model_title} - {location} - {column_translator[metric]}'
+    triggered = [t['prop_id'] for t in dash.callback_context.triggered]
+    if triggered == ['primary-graph.relayoutData'] and \
+            (dff.empty or dff.groupby('model_label').size().max() <= max_points_per_trace):
+        raise PreventUpdate
+    if triggered != ['primary-graph.relayoutData']:
+        #relayoutData keeps the last zoom after the store or the controls change, so only a zoom
+        #downsamples to its own range: anything else (e.g. a new location) gets the full range
+        relayout_data = None
+
+    plot_title = data['title']
 
     #different sequential colorscales for different models
     num_models_ihme = len(dff[dff.model_name == 'IHME'].model_version.unique())
@@ -521,18 +718,30 @@ def make_primary_graph(model, location, metric, start_date, end_date, log_scale,
         dff = dff[dff[metric] > 3] # prevent tiny log scale values from showing up
 
     if 'confirmed' in metric or 'dea' in metric and actual_values:
-        if 'LANL' in dff.model_name.unique():
-            act_dff = dff[dff.model_name == 'LANL']
-            act_dff = act_dff[(act_dff.date <= act_dff.model_date) & (act_dff.model_date == act_dff.model_date.max())]
+        act_dff = decode_actuals(data)
+        if act_dff is not None:
+            # rolling means for the common window sizes are precomputed in the actuals table
+            if smoothed and f'rolling_{window_size}' in act_dff:
+                act_dff[f'rolling_{metric}'] = act_dff[f'rolling_{window_size}']
+            elif smoothed:
+                act_dff[f'rolling_{metric}'] = act_dff[metric].rolling(window=window_size).mean()
+            if y_axis_type == 'log':
+                act_dff = act_dff[act_dff[metric] > 3]
         else:
-            act_dff = dff[(dff.date <= dff.model_date) & (dff.model_date == dff.model_date.max())]
-        if smoothed:
-            act_dff[f'rolling_{metric}'] = act_dff[metric].rolling(window=window_size).mean()
-        act_dff = act_dff.drop_duplicates(keep='first')
-
-
+            #fall back to the observed part of the newest forecast until the actuals table is built
+            if 'LANL' in dff.model_name.unique():
+                act_dff = dff[dff.model_name == 'LANL']
+                act_dff = act_dff[(act_dff.date <= act_dff.model_date) & (act_dff.model_date == act_dff.model_date.max())]
+            else:
+                act_dff = dff[(dff.date <= dff.model_date) & (dff.model_date == dff.model_date.max())]
+            if smoothed:
+                act_dff[f'rolling_{metric}'] = act_dff[metric].rolling(window=window_size).mean()
+            act_dff = act_dff.drop_duplicates(keep='first')
+
+
+        line_dff, render_mode = reduce_lines(dff[dff.date > dff.model_date], metric, relayout_data)
         fig = px.line(
-            dff[dff.date > dff.model_date],
+            line_dff,
             x='date',
             y=metric,
             color='model_label',
@@ -541,6 +750,7 @@ def make_primary_graph(model, location, metric, start_date, end_date, log_scale,
             labels=column_translator,
             hover_name='model_version',
             hover_data=['model_name'],
+            render_mode=render_mode,
         )
         actual = px.bar(
             act_dff,
@@ -551,8 +761,9 @@ def make_primary_graph(model, location, metric, start_date, end_date, log_scale,
         )
         fig.add_trace(actual.data[0])
     else:
+        line_dff, render_mode = reduce_lines(dff, metric, relayout_data)
         fig = px.line(
-            dff,
+            line_dff,
             x='date',
             y=metric,
             color='model_label',
@@ -560,7 +771,8 @@ def make_primary_graph(model, location, metric, start_date, end_date, log_scale,
             title=plot_title,
             labels=column_translator,
             hover_name='model_version',
-            hover_data=['model_name']
+            hover_data=['model_name'],
+            render_mode=render_mode,
         )
 
     fig.layout.template = 'ggplot2'
@@ -586,13 +798,27 @@ def make_primary_graph(model, location, metric, start_date, end_date, log_scale,
             )
         ],
         yaxis=dict(fixedrange=True), #fix y-axis for scrollZoom to work properly
-        yaxis_type=y_axis_type
+        yaxis_type=y_axis_type,
+        uirevision=f"{data['location']}-{metric}" #keep the zoom when re-rendering the same series
     )
 
     if y_axis_type == 'log':
         fig.update_layout(yaxis = {'dtick': 1})
 
-    return fig, cards
+    return fig
+
+if app_config['clientside_rendering']:
+    # the browser builds the figure from the store payload (assets/clientside.js), so presentation
+    # changes cost no server cpu and no figure json is sent
+    app.clientside_callback(
+        ClientsideFunction(namespace='projections', function_name='render_figure'),
+        Output("primary-graph", "figure"),
+        graph_inputs, #no relayoutData: this renderer does not downsample, so zooming needs no re-render
+        [State("render-config", "data")],
+    )
+else:
+    #the server renderer downsamples to the visible range, so it re-renders on zoom
+    app.callback(Output("primary-graph", "figure"), graph_inputs + [Input("primary-graph", "relayoutData")])(make_primary_graph)
 
 if __name__ == "__main__":
     app.run_server(debug=app_config['debug'], port=5000)
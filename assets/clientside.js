@@ -0,0 +1,199 @@
+// Clientside renderer for the primary graph, used when clientside_rendering is set in config.py.
+// Mirrors make_primary_graph in app.py, working from the compact payload written by encode_store:
+// dictionary encoded model labels, epoch-day dates and base64 float32 values.
+
+var decode_float32 = function (b64) {
+    var bytes = atob(b64);
+    var buffer = new Uint8Array(bytes.length);
+    for (let i = 0; i < bytes.length; i++) {
+        buffer[i] = bytes.charCodeAt(i);
+    }
+    return new Float32Array(buffer.buffer);
+};
+
+var iso_day = function (day) {
+    return new Date(day * 86400000).toISOString().slice(0, 10);
+};
+
+// dash checklists give false, [] or [value]: like python, only a non-empty list counts as checked
+var is_checked = function (value) {
+    return Array.isArray(value) ? value.length > 0 : Boolean(value);
+};
+
+// like pandas rolling(window).mean(): null until a full window is available
+var rolling_mean = function (values, window_size) {
+    return values.map(function (v, j) {
+        if (j + 1 < window_size) {
+            return null;
+        }
+        var total = 0;
+        for (let k = j + 1 - window_size; k <= j; k++) {
+            total += values[k];
+        }
+        return total / window_size;
+    });
+};
+
+var local_now = function () {
+    var now = new Date();
+    return new Date(now.getTime() - now.getTimezoneOffset() * 60000).toISOString().slice(0, 19).replace('T', ' ');
+};
+
+var render_figure = function (data, log_scale, smoothed, window_size, actual_values, color_scale_ihme, color_scale_lanl, config) {
+    if (!data || !config) {
+        return {data: [], layout: {}};
+    }
+
+    var metric = data.metric;
+    var codes = data.label;
+    var days = data.day;
+    var values = decode_float32(data.value);
+    var label_names = data.label_model_name;
+    var label_dates = data.label_model_date;
+    var log = is_checked(log_scale);
+
+    // different sequential colorscales for different models, using the darkest colours of each scale
+    var num_models_ihme = label_names.filter(function (name) { return name === 'IHME'; }).length;
+    var num_models_lanl = label_names.filter(function (name) { return name === 'LANL'; }).length;
+    var ihme_color_scale = config.color_scales[color_scale_ihme];
+    var lanl_color_scale = config.color_scales[color_scale_lanl];
+    var colors = ihme_color_scale.slice(ihme_color_scale.length - num_models_ihme)
+        .concat(lanl_color_scale.slice(lanl_color_scale.length - num_models_lanl));
+
+    // rows left after the log scale filter, which hides tiny values
+    var rows = [];
+    for (let i = 0; i < codes.length; i++) {
+        if (!log || values[i] > 3) {
+            rows.push(i);
+        }
+    }
+
+    var plot_actuals = metric.indexOf('confirmed') >= 0 || (metric.indexOf('dea') >= 0 && is_checked(actual_values));
+    var traces = [];
+    var line_rows = rows;
+
+    if (plot_actuals) {
+        var act_days, act_y;
+        var rolling_window = window_size || 7;
+        var y_title = metric;
+
+        if (data.actuals) {
+            // observed series from the actuals table, with precomputed rolling means for the common windows
+            act_days = data.actuals.day;
+            act_y = Array.from(decode_float32(data.actuals.value));
+            if (is_checked(smoothed)) {
+                act_y = data.actuals.rolling[rolling_window] ?
+                    Array.from(decode_float32(data.actuals.rolling[rolling_window])) : rolling_mean(act_y, rolling_window);
+                y_title = 'rolling_' + metric;
+            }
+            if (log) {
+                var act_values = decode_float32(data.actuals.value);
+                var kept = act_days.map(function (day, j) { return j; }).filter(function (j) { return act_values[j] > 3; });
+                act_days = kept.map(function (j) { return act_days[j]; });
+                act_y = kept.map(function (j) { return act_y[j]; });
+            }
+        } else {
+            // fall back to the observed part (date <= model_date) of the newest LANL run if LANL is selected
+            var has_lanl = rows.some(function (i) { return label_names[codes[i]] === 'LANL'; });
+            var act_rows = rows.filter(function (i) { return !has_lanl || label_names[codes[i]] === 'LANL'; });
+            var max_model_date = Math.max.apply(null, act_rows.map(function (i) { return label_dates[codes[i]]; }));
+            act_rows = act_rows.filter(function (i) {
+                return label_dates[codes[i]] === max_model_date && days[i] <= label_dates[codes[i]];
+            });
+            act_days = act_rows.map(function (i) { return days[i]; });
+            act_y = act_rows.map(function (i) { return values[i]; });
+            if (is_checked(smoothed)) {
+                act_y = rolling_mean(act_y, rolling_window);
+                y_title = 'rolling_' + metric;
+            }
+        }
+
+        var act_x = act_days.map(iso_day);
+        traces.push({
+            type: 'bar',
+            x: act_x,
+            y: act_y,
+            hovertext: act_x,
+            marker: {color: '#696969'},
+            showlegend: false,
+            hovertemplate: '<b>%{hovertext}</b><br><br>Date=%{x}<br>' + y_title + '=%{y}<extra></extra>'
+        });
+
+        line_rows = rows.filter(function (i) { return days[i] > label_dates[codes[i]]; });
+    }
+
+    // one line per model label, coloured in order of appearance like plotly express
+    var lines = {};
+    var order = [];
+    line_rows.forEach(function (i) {
+        var code = codes[i];
+        if (!(code in lines)) {
+            var label = data.labels[code];
+            lines[code] = {
+                type: 'scatter',
+                mode: 'lines',
+                name: label,
+                legendgroup: label,
+                showlegend: true,
+                line: {color: colors.length ? colors[order.length % colors.length] : undefined, dash: 'solid'},
+                x: [],
+                y: [],
+                hovertext: [],
+                customdata: [],
+                hovertemplate: '<b>%{hovertext}</b><br><br>model_label=' + label + '<br>Date=%{x}<br>' +
+                    data.metric_label + '=%{y}<br>model_name=%{customdata[0]}<extra></extra>'
+            };
+            order.push(code);
+        }
+        lines[code].x.push(iso_day(days[i]));
+        lines[code].y.push(values[i]);
+        lines[code].hovertext.push(data.label_model_version[code]);
+        lines[code].customdata.push([label_names[code]]);
+    });
+    // lines are drawn below the actuals bar in make_primary_graph
+    var line_traces = order.map(function (code) { return lines[code]; });
+
+    // switch to WebGL for figures with many traces or points
+    if (line_traces.length > config.webgl_trace_threshold || line_rows.length > config.webgl_point_threshold) {
+        line_traces.forEach(function (trace) { trace.type = 'scattergl'; });
+    }
+    traces = line_traces.concat(traces);
+
+    var today = local_now();
+    var layout = {
+        template: config.template,
+        title: {text: data.title},
+        xaxis: {title: {text: 'Date'}},
+        yaxis: {title: {text: data.metric_label}, fixedrange: true, type: log ? 'log' : '-'},
+        showlegend: true,
+        annotations: [{
+            x: 0.01,
+            y: 0.98,
+            xref: 'paper',
+            yref: 'paper',
+            text: '@CovidProjection',
+            showarrow: false
+        }],
+        legend: {title: {text: '<b>Model Date</b>'}, orientation: 'v', x: 1, y: 0.5, tracegroupgap: 0},
+        margin: {l: 40, r: 40, t: 40, b: 40},
+        // keep the zoom when re-rendering the same series
+        uirevision: data.location + '-' + metric,
+        shapes: [{
+            type: 'line',
+            yref: 'paper', y0: 0, y1: 1,
+            xref: 'x', x0: today, x1: today,
+            line: {color: 'Black', width: 2, dash: 'dashdot'}
+        }]
+    };
+    if (log) {
+        layout.yaxis.dtick = 1;
+    }
+
+    return {data: traces, layout: layout};
+};
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    projections: {
+        render_figure: render_figure
+    }
+});
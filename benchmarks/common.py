@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Shared helpers for the offline benchmarks in this folder
+
+import os
+import sys
+import importlib.util
+
+from sqlalchemy import text
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+from plot_option_data import table_dtypes
+
+sql_types = {'category': 'TEXT', 'object': 'TEXT', 'float32': 'REAL', 'datetime64[ns]': 'TIMESTAMP'}
+
+def load_scraper():
+    '''
+    import projections-scraper.py (not importable by name because of the dash)
+    returns: module
+    '''
+    spec = importlib.util.spec_from_file_location('projections_scraper', os.path.join(REPO_ROOT, 'projections-scraper.py'))
+    scraper = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(scraper)
+    return scraper
+
+def print_table(rows, columns):
+    '''
+    print a list of dicts as an aligned text table
+    '''
+    widths = {c: max(len(c), *(len(str(r.get(c, ''))) for r in rows)) for c in columns}
+    print('  '.join(c.ljust(widths[c]) for c in columns))
+    for r in rows:
+        print('  '.join(str(r.get(c, '')).ljust(widths[c]) for c in columns))
+
+def reset_projections_table(engine, table_name):
+    '''
+    recreate an empty projections table with the production primary key
+    '''
+    cols = ', '.join(f'"{c}" {sql_types[dtype]}' for c, dtype in table_dtypes.items())
+    with engine.begin() as conn:
+        conn.execute(text(f'DROP TABLE IF EXISTS {table_name}'))
+        conn.execute(text(f'CREATE TABLE {table_name} ({cols}, PRIMARY KEY (location_name, date, model_date, model_name))'))
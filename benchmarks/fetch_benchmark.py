@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Offline benchmark for the scraper fetch stages (get_lanl_df / get_ihme_df).
+# Starts a local HTTP server that stands in for covid-19.bsvgateway.org and healthdata.org:
+# synthetic LANL csvs under both filename schemes (before and after the 2020-10-28 update),
+# IHME zip archives and a downloads page that get_ihme_filelist can parse.
+# Responses carry ETags so the download cache revalidation path is exercised too.
+# Latency and the share of missing (404) LANL files are configurable.
+#
+# usage: python benchmarks/fetch_benchmark.py --latency-ms 50 --missing-rate 0.6 --workers 8
+
+import io
+import os
+import json
+import time
+import shutil
+import hashlib
+import zipfile
+import argparse
+import tempfile
+import threading
+from datetime import date, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+import pandas as pd
+
+from common import load_scraper, print_table
+
+scraper = load_scraper()
+
+from downloader import Downloader
+from download_cache import DownloadCache
+from probe_index import ProbeIndex
+from ihme_manifest import IhmeManifest
+from plot_option_data import csv_dtypes
+
+lanl_quantiles = ['q.01','q.025','q.05','q.10','q.15','q.20','q.25','q.30','q.35','q.40','q.45','q.50',
+                  'q.55','q.60','q.65','q.70','q.75','q.80','q.85','q.90','q.95','q.975','q.99']
+
+
+class SyntheticSource:
+    '''
+    generates LANL and IHME files on request
+    locations: number of locations per file
+    horizon: number of days in each forecast
+    missing_rate: share of LANL urls answered with a 404 (chosen deterministically per url)
+    '''
+
+    def __init__(self, locations=50, horizon=60, ihme_versions=4, missing_rate=0.5, latency=0.0):
+        self.locations = [f'Location {i}' for i in range(locations)]
+        self.horizon = horizon
+        self.missing_rate = missing_rate
+        self.latency = latency
+        self.ihme_versions = [str(date(2020, 10, 1) + timedelta(days=7 * i)).replace('-', '_') for i in range(ihme_versions)]
+        self._zips = {}
+        self._lock = threading.Lock()
+        self.stats = {'requests': 0, 'files': 0, 'not_modified': 0, 'not_found': 0, 'bytes': 0}
+
+    def is_missing(self, path):
+        bucket = int(hashlib.md5(path.encode('utf8')).hexdigest()[:8], 16) / 0xffffffff
+        return bucket < self.missing_rate
+
+    def lanl_csv(self, fcst_date, metric, geo):
+        '''
+        returns: csv bytes using the column names of the filename scheme in use on fcst_date
+        '''
+        start = date.fromisoformat(fcst_date) - timedelta(days=self.horizon // 2)
+        dates = [str(start + timedelta(days=i)) for i in range(self.horizon)]
+        rng = np.random.default_rng(abs(hash((fcst_date, metric, geo))) % 2**32)
+
+        n = len(dates) * len(self.locations)
+        daily = rng.gamma(2.0, 50.0, size=(len(self.locations), len(dates)))
+        base = np.cumsum(daily, axis=1).reshape(n)
+        df = pd.DataFrame({q: base * (0.5 + float(q[2:].ljust(3, '0')) / 1000) for q in lanl_quantiles})
+
+        location_col = 'state' if geo == 'us' else 'countries'
+        if fcst_date > '2020-10-28':
+            location_col = 'name'
+        df.insert(0, 'date' if fcst_date > '2020-10-28' else 'dates', dates * len(self.locations))
+        df[location_col] = np.repeat(self.locations, len(dates))
+        df['obs'] = base
+        df['fcst_date'] = fcst_date
+        df['simple_state'] = df[location_col]
+        return df.to_csv(index=False).encode('utf8')
+
+    def ihme_zip(self, version):
+        with self._lock:
+            if version not in self._zips:
+                start = date.fromisoformat(version.replace('_', '-'))
+                dates = [str(start + timedelta(days=i)) for i in range(self.horizon)]
+                cols = [c for c in csv_dtypes if csv_dtypes[c] == 'float32' and 'confirmed' not in c]
+                rng = np.random.default_rng(len(self._zips))
+                df = pd.DataFrame(rng.gamma(2.0, 50.0, size=(len(dates) * len(self.locations), len(cols))), columns=cols)
+                df.insert(0, 'location_name', np.repeat(self.locations, len(dates)))
+                df.insert(1, 'date', dates * len(self.locations))
+                df['total_pop'] = 1e6 #an ignored column, as in real archives
+
+                buf = io.BytesIO()
+                with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as zf:
+                    zf.writestr(f'{version}/', '')
+                    zf.writestr(f'{version}/Reference_hospitalization_all_locs.csv', df.to_csv(index=False))
+                    zf.writestr(f'{version}/Readme.txt', 'synthetic archive\n')
+                self._zips[version] = buf.getvalue()
+            return self._zips[version]
+
+    def downloads_page(self, base_url):
+        #newest archive first, like the real page
+        links = ''.join(
+            f'<p><a href="{base_url}/ihmecovid19storage/archive/{v}/ihme-covid19.zip">{v}</a></p>\n'
+            for v in reversed(self.ihme_versions)
+        )
+        return f'<html><body><h1>COVID-19 data downloads</h1>\n{links}</body></html>'.encode('utf8')
+
+    def respond(self, path, base_url):
+        '''
+        returns: (status, body, content type)
+        '''
+        parts = path.strip('/').split('/')
+        if path == '/covid/data-downloads':
+            return 200, self.downloads_page(base_url), 'text/html'
+
+        if len(parts) == 5 and parts[0] == 'forecast' and parts[3] == 'files':
+            geo, fcst_date, fname = parts[1], parts[2], parts[4]
+            for metric in ['deaths', 'confirmed']:
+                if scraper.lanl_url(fcst_date, metric, geo)[0] == fname:
+                    if self.is_missing(path):
+                        return 404, b'not found', 'text/plain'
+                    return 200, self.lanl_csv(fcst_date, metric, geo), 'text/csv'
+            return 404, b'not found', 'text/plain'
+
+        if len(parts) == 4 and parts[0] == 'ihmecovid19storage' and parts[2] in self.ihme_versions:
+            return 200, self.ihme_zip(parts[2]), 'application/zip'
+
+        return 404, b'not found', 'text/plain'
+
+
+def start_server(source):
+    '''
+    start the stand-in server on a free local port
+    returns: (server, base url)
+    '''
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1' #keep-alive, like the real hosts
+
+        def do_GET(self, head=False):
+            if source.latency:
+                time.sleep(source.latency)
+            status, body, content_type = source.respond(self.path, base_url)
+            etag = '"' + hashlib.md5(body).hexdigest() + '"'
+            if status == 200 and self.headers.get('If-None-Match') == etag:
+                status, body = 304, b''
+
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            if status in (200, 304):
+                self.send_header('ETag', etag)
+            self.end_headers()
+            with source._lock:
+                source.stats['requests'] += 1
+                if head:
+                    return
+                source.stats['bytes'] += len(body)
+                source.stats[{200: 'files', 304: 'not_modified'}.get(status, 'not_found')] += 1
+            self.wfile.write(body)
+
+        def do_HEAD(self):
+            self.do_GET(head=True)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    base_url = f'http://127.0.0.1:{server.server_address[1]}'
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, base_url
+
+def run_stage(name, source, fn):
+    before = dict(source.stats)
+    start = time.time()
+    rows = fn()
+    elapsed = time.time() - start
+    stats = {k: source.stats[k] - before[k] for k in before}
+    return {
+        'stage': name,
+        'seconds': round(elapsed, 2),
+        'requests': stats['requests'],
+        'files': stats['files'],
+        'not_modified': stats['not_modified'],
+        'not_found': stats['not_found'],
+        'MB': round(stats['bytes'] / 1024**2, 2),
+        'files/s': round((stats['files'] + stats['not_modified']) / elapsed, 1),
+        'MB/s': round(stats['bytes'] / 1024**2 / elapsed, 2),
+        'rows': rows,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the scraper fetch stages against a local stand-in server')
+    parser.add_argument('--min-date', default='2020-10-14', help='exclusive start of the LANL window (default straddles the 2020-10-28 filename change)')
+    parser.add_argument('--max-date', default='2020-11-11', help='inclusive end of the LANL window')
+    parser.add_argument('--locations', type=int, default=50)
+    parser.add_argument('--horizon', type=int, default=60, help='days per forecast file')
+    parser.add_argument('--ihme-versions', type=int, default=4)
+    parser.add_argument('--latency-ms', type=float, default=20.0, help='server latency per request')
+    parser.add_argument('--missing-rate', type=float, default=0.5, help='share of LANL urls that return 404')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--parse-workers', type=int, default=1)
+    parser.add_argument('--max-per-host', type=int, default=4)
+    parser.add_argument('--rate-limit', type=float, default=0, help='requests/s per host, 0 disables the limit')
+    parser.add_argument('--cache', action='store_true', help='run with the download cache and probe index, twice (cold then warm)')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    source = SyntheticSource(args.locations, args.horizon, args.ihme_versions, args.missing_rate, args.latency_ms / 1000)
+    server, base_url = start_server(source)
+    scraper.LANL_BASE_URL = base_url
+    scraper.IHME_DOWNLOADS_URL = f'{base_url}/covid/data-downloads'
+
+    workdir = tempfile.mkdtemp(prefix='fetch-benchmark-')
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    os.mkdir('data')
+    results = []
+    try:
+        for run in (['cold', 'warm'] if args.cache else ['cold']):
+            if run == 'warm':
+                #drop the stored partitions so the warm run has to fetch again, through the cache
+                shutil.rmtree(os.path.join('data', 'store'))
+            cache = DownloadCache() if args.cache else None
+            probe_index = ProbeIndex() if args.cache else None
+            downloader = Downloader(max_concurrency=args.max_per_host, rate_limit=args.rate_limit, cache=cache)
+
+            lanl = run_stage(f'lanl ({run})', source, lambda: scraper.get_lanl_df(
+                args.min_date, workers=args.workers, downloader=downloader, probe_index=probe_index,
+                parse_workers=args.parse_workers, max_date=args.max_date))
+            ihme = run_stage(f'ihme ({run})', source, lambda: len(scraper.get_ihme_df(
+                args.min_date, downloader=downloader, parse_workers=args.parse_workers)))
+            results += [lanl, ihme]
+            if args.cache:
+                #once the manifest has seen every archive, a rerun only fetches the page and HEADs each archive
+                manifest = IhmeManifest()
+                scraper.get_ihme_df(args.min_date, downloader=downloader, manifest=manifest)
+                results.append(run_stage(f'ihme manifest ({run})', source, lambda: len(scraper.get_ihme_df(
+                    args.min_date, downloader=downloader, manifest=manifest) or [])))
+                cache.save() #the next run opens the cache from disk, like the scraper after its download stages
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+        server.shutdown()
+
+    print()
+    print_table(results, ['stage','seconds','requests','files','not_modified','not_found','MB','files/s','MB/s','rows'])
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'args': vars(args), 'results': results}, f, indent=1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Synthetic-scale benchmark for the merge and load stages.
+# For every requested number of model versions a fresh data directory is filled with synthetic
+# compiled data (see synthetic_data.py), then process_lanl_compiled, merge_projections and
+# create_projections_table are run through the scraper Pipeline, which records wall time,
+# peak RSS and rows per stage. The load stage needs a local postgres database.
+#
+# usage: python benchmarks/merge_load_benchmark.py --versions 10 100 --locations 60 --horizon 120 \
+#            --db-uri postgresql+psycopg2://postgres@localhost/covid_projections_bench
+
+import os
+import json
+import shutil
+import argparse
+import tempfile
+
+from sqlalchemy import create_engine
+
+from common import load_scraper, print_table, reset_projections_table
+
+scraper = load_scraper()
+
+from config import app_config
+from pipeline import Pipeline, fingerprint
+from intermediates import PartitionedStore
+import synthetic_data
+
+def run_scale(args, versions):
+    '''
+    generate data for one scale and run the merge/load stages on it
+    returns: list of per-stage report entries
+    '''
+    workdir = tempfile.mkdtemp(prefix='merge-load-benchmark-')
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        os.mkdir('data')
+        generated = synthetic_data.generate(args.locations, versions, args.horizon)
+        print(f'generated {generated} rows for {versions} versions')
+
+        lanl_keys = PartitionedStore('lanl_deaths').pending('merge')
+
+        pipeline = Pipeline(force=True)
+        pipeline.stage('process_lanl', lambda: sum(len(scraper.process_lanl_compiled(m, lanl_keys)) for m in ['deaths', 'confirmed']),
+                       lambda: fingerprint('process_lanl'))
+        pipeline.stage('merge', lambda: scraper.merge_projections(max_memory_mb=args.merge_memory_mb), lambda: fingerprint('merge'))
+        if args.db_uri:
+            pipeline.stage('load', lambda: scraper.create_projections_table(method=args.load_method, workers=args.load_workers),
+                           lambda: fingerprint('load'))
+        pipeline.run()
+
+        return [dict(entry, versions=versions, generated_rows=generated) for entry in pipeline.report['stages']]
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark merge and load stages on synthetic data')
+    parser.add_argument('--versions', type=int, nargs='+', default=[10, 100], help='model versions per model, one run per value')
+    parser.add_argument('--locations', type=int, default=60)
+    parser.add_argument('--horizon', type=int, default=120, help='days per forecast')
+    parser.add_argument('--merge-memory-mb', type=int, default=512)
+    parser.add_argument('--load-method', choices=['upsert','copy'], default='copy')
+    parser.add_argument('--load-workers', type=int, default=1)
+    parser.add_argument('--db-uri', help='local database for the load stage (the table named in config.py is dropped and recreated); '
+                                         'the load stage is skipped if not given')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    if args.db_uri:
+        if args.db_uri == app_config['sqlalchemy_database_uri']:
+            parser.error('refusing to benchmark against the production database')
+        scraper.engine = create_engine(args.db_uri, pool_size=max(5, args.load_workers))
+
+    results = []
+    for versions in args.versions:
+        if args.db_uri:
+            reset_projections_table(scraper.engine, app_config['database_name'])
+        results += run_scale(args, versions)
+
+    print()
+    print_table(results, ['versions','generated_rows','stage','wall_time_s','peak_rss_mb','rows'])
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'args': vars(args), 'results': results}, f, indent=1)
+
+if __name__ == "__main__":
+    main()
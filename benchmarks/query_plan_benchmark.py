@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Before/after query plan benchmark for migrate_projections.py.
+# For every requested history size a local projections table is filled with synthetic forecasts
+# (one IHME and one LANL version per day), then the dashboard's filter_df query is run with
+# EXPLAIN (ANALYZE, BUFFERS) for a fixed model_date window, first on the plain table and again after
+# the partition and index migrations. With the migrations the execution time and buffers read should stay
+# flat as history grows, since the window always covers the same number of rows.
+#
+# usage: python benchmarks/query_plan_benchmark.py --versions 30 120 360 --locations 60 --horizon 120 \
+#            --db-uri postgresql+psycopg2://postgres@localhost/covid_projections_bench
+
+import json
+import argparse
+import statistics
+from datetime import date, timedelta
+
+from sqlalchemy import create_engine, text
+
+from common import print_table, reset_projections_table
+
+from config import app_config
+from queries import filter_query, filter_params
+import migrate_projections
+
+def fill_projections(engine, table_name, locations, versions, horizon, start=date(2020, 4, 1)):
+    '''
+    insert synthetic forecasts with generate_series: `versions` model dates for IHME and LANL,
+    each covering `horizon` days for `locations` locations
+    returns: rows inserted
+    '''
+    with engine.begin() as conn:
+        rows = conn.execute(text(f'''
+            INSERT INTO {table_name} (location_name, date, model_date, model_name, model_version, location_abbr,
+                                      deaths_mean, totdea_mean, confirmed_mean)
+            SELECT 'Location ' || l, md + (d - {horizon // 3}) * interval '1 day', md, m, to_char(md, 'YYYY_MM_DD'), 'L' || l,
+                   random() * 100, random() * 1000, random() * 10000
+            FROM generate_series(1, {locations}) l,
+                 generate_series(timestamp '{start}', timestamp '{start}' + interval '{versions - 1} days', interval '1 day') md,
+                 generate_series(0, {horizon - 1}) d,
+                 unnest(ARRAY['IHME', 'LANL']) m
+        ''')).rowcount
+        conn.execute(text(f'ANALYZE {table_name}'))
+    return rows
+
+def explain_filter(engine, table_name, location, start_date, end_date, metric='deaths_mean', model=('IHME', 'LANL')):
+    '''
+    returns: dict with execution/planning time, shared buffers and the node types of the plan
+    '''
+    query = 'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + filter_query(table_name, metric, len(model))
+    conn = engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(query, filter_params(list(model), location, start_date, end_date))
+        plan = cursor.fetchone()[0][0]
+    finally:
+        conn.close()
+
+    nodes, stack = [], [plan['Plan']]
+    while stack:
+        node = stack.pop()
+        nodes.append(node['Node Type'])
+        stack.extend(node.get('Plans', []))
+
+    return {
+        'execution_ms': plan['Execution Time'],
+        'planning_ms': plan['Planning Time'],
+        'buffers': plan['Plan'].get('Shared Hit Blocks', 0) + plan['Plan'].get('Shared Read Blocks', 0),
+        'rows_returned': plan['Plan']['Actual Rows'],
+        'nodes': sorted(set(nodes)),
+    }
+
+def measure(engine, table_name, args, last_model_date):
+    '''
+    run the filter query for the last `window` days of model dates at several locations
+    returns: dict of medians over all runs
+    '''
+    start_date = last_model_date - timedelta(days=args.window - 1)
+    runs = []
+    for _ in range(args.repeat):
+        for i in range(1, args.locations + 1, max(1, args.locations // args.sample_locations)):
+            runs.append(explain_filter(engine, table_name, f'Location {i}', str(start_date), str(last_model_date)))
+
+    return {
+        'execution_ms': round(statistics.median(r['execution_ms'] for r in runs), 2),
+        'planning_ms': round(statistics.median(r['planning_ms'] for r in runs), 2),
+        'buffers': int(statistics.median(r['buffers'] for r in runs)),
+        'rows_returned': int(statistics.median(r['rows_returned'] for r in runs)),
+        'plan': ','.join(sorted(set(n for r in runs for n in r['nodes']))),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the filter_df query plan before and after migrate_projections.py')
+    parser.add_argument('--versions', type=int, nargs='+', default=[30, 120, 360], help='days of model history, one run per value')
+    parser.add_argument('--locations', type=int, default=60)
+    parser.add_argument('--horizon', type=int, default=120, help='days per forecast')
+    parser.add_argument('--window', type=int, default=45, help='model_date window queried, in days (the dashboard default is 45)')
+    parser.add_argument('--sample-locations', type=int, default=5, help='locations queried per measurement')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--include-metric', action='append', default=[], help='passed on to the index migration')
+    parser.add_argument('--db-uri', required=True,
+                        help='local database to benchmark against (the table named in config.py is dropped and recreated)')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    if args.db_uri == app_config['sqlalchemy_database_uri']:
+        parser.error('refusing to benchmark against the production database')
+
+    engine = create_engine(args.db_uri)
+    table_name = app_config['database_name']
+    start = date(2020, 4, 1)
+
+    results = []
+    for versions in args.versions:
+        with engine.begin() as conn:
+            conn.execute(text(f'DROP TABLE IF EXISTS {table_name}_unpartitioned'))
+            conn.execute(text(f'DROP TABLE IF EXISTS {table_name} CASCADE'))
+        reset_projections_table(engine, table_name)
+        rows = fill_projections(engine, table_name, args.locations, versions, args.horizon, start=start)
+        last_model_date = start + timedelta(days=versions - 1)
+        print(f'{versions} versions: {rows} rows')
+
+        results.append(dict(measure(engine, table_name, args, last_model_date), versions=versions, table_rows=rows, layout='before'))
+        migrate_projections.migrate(engine, table_name, ['partition', 'index'], include_metrics=args.include_metric, drop_old=True)
+        results.append(dict(measure(engine, table_name, args, last_model_date), versions=versions, table_rows=rows, layout='after'))
+
+    print()
+    print_table(results, ['versions','table_rows','layout','execution_ms','planning_ms','buffers','rows_returned','plan'])
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'args': vars(args), 'results': results}, f, indent=1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Generator for synthetic compiled LANL/IHME data at configurable scale.
+# Data is written straight into the PartitionedStores the scraper uses (lanl_deaths, lanl_confirmed, ihme),
+# one model version at a time, so the merge and load stages can be benchmarked without downloading anything.
+
+from datetime import date, timedelta
+
+import numpy as np
+import pandas as pd
+
+from common import REPO_ROOT #noqa: F401 (puts the repo on sys.path)
+from intermediates import PartitionedStore
+from region_abbreviations import us_state_abbrev
+from source_schema import ihme_schema
+
+def location_names(n):
+    names = list(us_state_abbrev)[:n]
+    return names + [f'Synthetic Location {i}' for i in range(n - len(names))]
+
+def cumulative_quantiles(rng, n_locations, horizon):
+    '''
+    returns: (q05, q50, q95) arrays of shape (n_locations * horizon,), non-decreasing within each location
+    '''
+    daily = rng.gamma(2.0, 40.0, size=(n_locations, horizon))
+    q50 = np.cumsum(daily, axis=1)
+    spread = np.linspace(0.0, 0.3, horizon)
+    return tuple((q50 * (1 + s * spread)).reshape(-1) for s in (-1, 0, 1))
+
+def generate(locations=50, versions=10, horizon=90, start=date(2020, 5, 1), seed=0):
+    '''
+    write `versions` LANL forecasts (both metrics) and `versions` IHME forecasts of `locations` x `horizon` rows
+    returns: total rows written
+    '''
+    rng = np.random.default_rng(seed)
+    names = location_names(locations)
+    ihme_cols = [c for c, dtype in ihme_schema.columns.items() if dtype == 'float32']
+    stores = {name: PartitionedStore(name) for name in ['lanl_deaths', 'lanl_confirmed', 'ihme']}
+    rows = 0
+
+    for v in range(versions):
+        model_date = start + timedelta(days=3 * v)
+        first_day = model_date - timedelta(days=horizon // 3)
+        dates = pd.date_range(first_day, periods=horizon)
+
+        for metric in ['deaths', 'confirmed']:
+            q05, q50, q95 = cumulative_quantiles(rng, locations, horizon)
+            lanl = pd.DataFrame({
+                'dates': np.tile(dates, locations),
+                'q05': q05, 'q50': q50, 'q95': q95,
+                'location_name': np.repeat(names, horizon),
+                'fcst_date': str(model_date),
+            })
+            stores[f'lanl_{metric}'].write(lanl, 'fcst_date')
+            rows += len(lanl)
+
+        ihme = pd.DataFrame(rng.gamma(2.0, 40.0, size=(locations * horizon, len(ihme_cols))).astype('float32'), columns=ihme_cols)
+        ihme.insert(0, 'location_name', np.repeat(names, horizon))
+        ihme.insert(1, 'date', np.tile(dates, locations))
+        ihme['model_version'] = str(model_date + timedelta(days=1)).replace('-', '_')
+        stores['ihme'].write(ihme, 'model_version')
+        rows += len(ihme)
+
+    return rows
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# PostgreSQL bulk loader for the projections table.
+# Rows are streamed with COPY into an unlogged staging table and merged into the target
+# with a single INSERT ... ON CONFLICT DO NOTHING, so deduplication happens in the database.
+
+import io
+
+index_col = ['location_name', 'date', 'model_date', 'model_name']
+
+def table_columns(cursor, table_name):
+    cursor.execute(
+        "SELECT column_name FROM information_schema.columns WHERE table_name = %s ORDER BY ordinal_position",
+        (table_name,)
+    )
+    return [row[0] for row in cursor.fetchall()]
+
+def copy_upsert(engine, df, table_name, chunksize=100000, staging_table=None, replace=None):
+    '''
+    bulk insert df into table_name, skipping rows whose (location_name, date, model_date, model_name)
+    key already exists
+    df: frame with the key columns either as columns or as the index
+    staging_table: name of the unlogged staging table (default {table_name}_staging),
+        concurrent loaders must each use their own
+    replace: optional list of (model_name, model_version) whose existing rows are deleted in the same
+        transaction before the insert, e.g. for re-published model versions
+    returns: (rows inserted, rows skipped)
+    '''
+    if any(c in df.index.names for c in index_col):
+        df = df.reset_index()
+
+    if staging_table is None:
+        staging_table = f'{table_name}_staging'
+    conn = engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+
+        target_cols = table_columns(cursor, table_name)
+        cols = [c for c in df.columns if c in target_cols]
+        extra_cols = [c for c in df.columns if c not in target_cols]
+        if extra_cols:
+            print(f'warning: columns not in {table_name} are not loaded: {extra_cols}')
+
+        cursor.execute(f'CREATE UNLOGGED TABLE IF NOT EXISTS {staging_table} (LIKE {table_name} INCLUDING DEFAULTS)')
+        cursor.execute(f'TRUNCATE {staging_table}')
+
+        col_list = ', '.join(f'"{c}"' for c in cols)
+        staged = 0
+        for start in range(0, len(df), chunksize):
+            buf = io.StringIO()
+            df[cols].iloc[start:start + chunksize].to_csv(buf, index=False, header=False)
+            buf.seek(0)
+            cursor.copy_expert(f"COPY {staging_table} ({col_list}) FROM STDIN WITH (FORMAT csv, NULL '')", buf)
+            staged += min(chunksize, len(df) - start)
+
+        for model_name, model_version in replace or []:
+            cursor.execute(f'DELETE FROM {table_name} WHERE model_name = %s AND model_version = %s', (model_name, model_version))
+            print(f'{table_name}: replacing {cursor.rowcount} rows of {model_name} {model_version}')
+
+        key_list = ', '.join(f'"{c}"' for c in index_col)
+        cursor.execute(
+            f'INSERT INTO {table_name} ({col_list}) SELECT {col_list} FROM {staging_table} '
+            f'ON CONFLICT ({key_list}) DO NOTHING'
+        )
+        inserted = cursor.rowcount
+
+        cursor.execute(f'TRUNCATE {staging_table}')
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    return inserted, staged - inserted
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Small metadata catalog for the dashboard: locations, metrics that have data and model_date bounds.
+# The scraper rebuilds it after each load, so dashboard workers read one tiny table on boot
+# instead of scanning projections, and can optionally start from a json snapshot on disk.
+
+import os
+import json
+import time
+from datetime import datetime
+
+import pandas as pd
+
+from bulk_load import table_columns
+from plot_option_data import table_dtypes
+
+catalog_table = 'projections_catalog'
+
+def numeric_columns(columns):
+    return [c for c in columns if table_dtypes.get(c) == 'float32']
+
+def compute_catalog(engine, table_name='projections'):
+    '''
+    scan table_name for the catalog contents
+    returns: dict with locations, metrics (numeric columns with at least one value), min_model_date, max_model_date
+    '''
+    conn = engine.raw_connection()
+    try:
+        columns = table_columns(conn.cursor(), table_name)
+    finally:
+        conn.close()
+    metrics = numeric_columns(columns)
+
+    locations = pd.read_sql_query(f"SELECT DISTINCT location_name FROM {table_name} ORDER BY location_name", engine)
+    counts = pd.read_sql_query(
+        'SELECT MIN(model_date) AS min_model_date, MAX(model_date) AS max_model_date, ' +
+        ', '.join(f'COUNT("{c}") AS "{c}"' for c in metrics) +
+        f' FROM {table_name}',
+        engine
+    ).iloc[0]
+
+    return {
+        'locations': locations.location_name.tolist(),
+        'metrics': [c for c in metrics if counts[c] > 0],
+        'min_model_date': str(pd.Timestamp(counts['min_model_date']).date()),
+        'max_model_date': str(pd.Timestamp(counts['max_model_date']).date()),
+    }
+
+def refresh_catalog(engine, table_name='projections'):
+    '''
+    rebuild the catalog table from table_name in a single transaction
+    returns: the catalog dict
+    '''
+    catalog = compute_catalog(engine, table_name)
+    rows = [('location', v) for v in catalog['locations']] + \
+           [('metric', v) for v in catalog['metrics']] + \
+           [('min_model_date', catalog['min_model_date']), ('max_model_date', catalog['max_model_date'])]
+    updated_at = datetime.utcnow()
+
+    with engine.begin() as conn:
+        conn.execute(f'CREATE TABLE IF NOT EXISTS {catalog_table} (kind text NOT NULL, value text NOT NULL, updated_at timestamp)')
+        conn.execute(f'DELETE FROM {catalog_table}')
+        conn.execute(
+            f'INSERT INTO {catalog_table} (kind, value, updated_at) VALUES (%s, %s, %s)',
+            [(kind, value, updated_at) for kind, value in rows]
+        )
+
+    print(f"catalog: {len(catalog['locations'])} locations, {len(catalog['metrics'])} metrics, "
+          f"model dates {catalog['min_model_date']} - {catalog['max_model_date']}")
+    return catalog
+
+def read_catalog(engine):
+    '''
+    returns: the catalog dict from the catalog table, or None if it has not been built yet
+    '''
+    try:
+        df = pd.read_sql_query(f'SELECT kind, value FROM {catalog_table}', engine)
+    except Exception as e:
+        print(f'catalog table unavailable: {e}')
+        return None
+    if df.empty:
+        return None
+
+    values = df.groupby('kind')['value'].apply(list).to_dict()
+    return {
+        'locations': sorted(values.get('location', [])),
+        'metrics': sorted(values.get('metric', [])),
+        'min_model_date': values['min_model_date'][0],
+        'max_model_date': values['max_model_date'][0],
+    }
+
+def read_snapshot(path, max_age=None):
+    '''
+    returns: the catalog dict stored at path, or None if it is missing or older than max_age seconds
+    '''
+    try:
+        if max_age is not None and time.time() - os.path.getmtime(path) > max_age:
+            return None
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_snapshot(catalog, path):
+    #write to a temp file and rename so concurrently booting workers never read a partial file
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(catalog, f)
+    os.replace(tmp_path, path)
+
+def load_catalog(engine, snapshot_path=None, snapshot_max_age=3600):
+    '''
+    catalog for the dashboard, in order of preference:
+    a snapshot younger than snapshot_max_age, the catalog table, a scan of projections
+    (before the scraper has built the catalog), and finally a stale snapshot if the database is unreachable
+    a catalog read from the database is written back to snapshot_path
+    '''
+    if snapshot_path is not None:
+        catalog = read_snapshot(snapshot_path, max_age=snapshot_max_age)
+        if catalog is not None:
+            return catalog
+
+    try:
+        catalog = read_catalog(engine)
+        if catalog is None:
+            catalog = compute_catalog(engine)
+    except Exception:
+        catalog = read_snapshot(snapshot_path) if snapshot_path is not None else None
+        if catalog is None:
+            raise
+        print(f'database unavailable, using catalog snapshot {snapshot_path}')
+        return catalog
+
+    if snapshot_path is not None:
+        write_snapshot(catalog, snapshot_path)
+    return catalog
+
+def catalog_max_model_date(engine):
+    '''
+    cheap data version check for the dashboard caches, falls back to projections if the catalog is missing
+    '''
+    try:
+        df = pd.read_sql_query(f"SELECT value FROM {catalog_table} WHERE kind = 'max_model_date'", engine)
+        if not df.empty:
+            return df.iloc[0,0]
+    except Exception:
+        pass
+    df = pd.read_sql_query("SELECT MAX(model_date) FROM projections", engine)
+    return df.iloc[0,0]
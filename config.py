@@ -5,7 +5,13 @@ app_config = {
     'sqlalchemy_database_uri' : f'postgresql+psycopg2://postgres:{os.environ.get("COVID_PRED_POSTGRES_PASS")}@'\
                                     f'{os.environ.get("COVID_PRED_RDS_URL")}/covid_projections?sslmode=verify-ca'\
                                 f'&sslrootcert=rds-ca-2019-root.pem',
-    'database_name' : 'projections'
+    'database_name' : 'projections',
+    #optional json snapshot of the metadata catalog, lets workers boot without querying the database
+    'catalog_snapshot' : os.environ.get('COVID_PRED_CATALOG_SNAPSHOT'),
+    #build the primary graph in the browser from a compact payload instead of sending figure json
+    'clientside_rendering' : os.environ.get('COVID_PRED_CLIENTSIDE_RENDERING', '0') == '1',
+    #serve filter_df from the memory-mapped cube built by projections_cube.py in this directory
+    'cube_dir' : os.environ.get('COVID_PRED_CUBE_DIR')
 }
 
 plotly_config = dict(
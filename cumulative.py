@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Vectorized grouped differencing, used to turn cumulative forecast quantiles
+# (e.g. LANL q05/q50/q95) into daily values
+
+import numpy as np
+import pandas as pd
+
+def group_starts(df, group_cols):
+    '''
+    boolean array marking the first row of every run of equal group_cols values
+    df must already be sorted by group_cols
+    '''
+    starts = np.zeros(len(df), dtype=bool)
+    if len(df) == 0:
+        return starts
+    starts[0] = True
+    for c in group_cols:
+        col = df[c]
+        values = col.cat.codes.to_numpy() if isinstance(col.dtype, pd.CategoricalDtype) else col.to_numpy()
+        starts[1:] |= values[1:] != values[:-1]
+    return starts
+
+def grouped_diff(df, group_cols, order_col, value_cols, suffix='_diff', first='nan'):
+    '''
+    daily values from cumulative columns, differenced within each group_cols group
+    the frame is sorted once by group_cols + order_col and every value column is differenced
+    in a single numpy pass, with group boundaries taken from the sorted keys so values
+    never leak from one group into the next
+    first: 'nan' (default) leaves the first row of each group missing, since a cumulative
+        value with no previous day has no daily value; 'value' keeps the cumulative value
+    returns: sorted dataframe with a {col}{suffix} column for every value column
+    '''
+    df = df.sort_values(group_cols + [order_col]).reset_index(drop=True)
+
+    values = df[value_cols].to_numpy(dtype='float64')
+    diff = np.empty_like(values)
+    if len(values) > 0:
+        diff[0] = values[0]
+        np.subtract(values[1:], values[:-1], out=diff[1:])
+
+        starts = group_starts(df, group_cols)
+        diff[starts] = values[starts] if first == 'value' else np.nan
+
+    for i, c in enumerate(value_cols):
+        df[c + suffix] = diff[:, i]
+
+    return df
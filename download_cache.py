@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# On-disk, content-addressed cache for scraper downloads.
+# Bodies are stored once per sha256 under objects/, and index.json maps each url to its
+# blob plus the ETag/Last-Modified validators used to revalidate it.
+
+import os
+import json
+import time
+import atexit
+import hashlib
+import threading
+import tempfile
+
+
+class DownloadCache:
+    '''
+    url -> response body cache with LRU eviction
+    root: cache directory (created if missing)
+    max_bytes: size cap for stored bodies, least recently used urls are evicted first
+    offline: cache-only mode, the Downloader never touches the network
+    '''
+
+    def __init__(self, root=os.path.join('data', 'http_cache'), max_bytes=5 * 1024**3, offline=False):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.RLock()
+        self._index_path = os.path.join(root, 'index.json')
+        os.makedirs(os.path.join(root, 'objects'), exist_ok=True)
+        self._index = self._load_index()
+        self._dirty = False
+        self._pins = {} #sha256 -> number of open users, pinned blobs are never evicted
+        atexit.register(self.save)
+
+    def _load_index(self):
+        if not os.path.exists(self._index_path):
+            return {}
+        try:
+            with open(self._index_path) as f:
+                return json.load(f)
+        except ValueError:
+            print(f'warning: ignoring corrupt cache index {self._index_path}')
+            return {}
+
+    def _save_index(self):
+        self._dirty = False
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self._index, f)
+        os.replace(tmp_path, self._index_path)
+
+    def blob_path(self, digest):
+        return os.path.join(self.root, 'objects', digest[:2], digest)
+
+    def lookup(self, url):
+        '''
+        returns: index entry for url (dict with sha256, etag, last_modified, size) or None
+        '''
+        with self._lock:
+            entry = self._index.get(url)
+            if entry is not None and not os.path.exists(self.blob_path(entry['sha256'])):
+                #blob was removed from disk behind our back
+                del self._index[url]
+                entry = None
+            return dict(entry) if entry is not None else None
+
+    def validators(self, url):
+        '''
+        returns: conditional request headers for a cached url
+        '''
+        entry = self.lookup(url)
+        headers = {}
+        if entry is None:
+            return headers
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def read(self, url):
+        '''
+        returns: cached body for url as bytes, or None if not cached
+        '''
+        entry = self.lookup(url)
+        if entry is None:
+            self.misses += 1
+            return None
+        with open(self.blob_path(entry['sha256']), 'rb') as f:
+            content = f.read()
+        self.touch(url)
+        self.hits += 1
+        return content
+
+    def touch(self, url):
+        #index changes (access times, stored and evicted urls) only live in memory until save(),
+        #so a run does not rewrite the whole index for every file; the scraper saves after each
+        #download stage and at exit, and lookup() drops entries whose blob is gone
+        with self._lock:
+            if url in self._index:
+                self._index[url]['last_access'] = time.time()
+                self._dirty = True
+
+    def save(self):
+        '''
+        write the index if it changed since it was last written
+        '''
+        with self._lock:
+            if self._dirty and os.path.isdir(self.root): #the cache directory may be gone by exit (e.g. benchmark workdirs)
+                self._save_index()
+
+    def path(self, url, pin=False):
+        '''
+        pin: keep the blob from being evicted until unpin(path) is called
+        returns: path of the cached body for url, or None if not cached
+        '''
+        with self._lock:
+            entry = self.lookup(url)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.touch(url)
+            self.hits += 1
+            if pin:
+                self._pin(entry['sha256'])
+        return self.blob_path(entry['sha256'])
+
+    def _pin(self, digest):
+        self._pins[digest] = self._pins.get(digest, 0) + 1
+
+    def unpin(self, path):
+        '''
+        release a blob pinned by path() or store_file()
+        '''
+        digest = os.path.basename(path)
+        with self._lock:
+            if self._pins.get(digest, 0) > 1:
+                self._pins[digest] -= 1
+            else:
+                self._pins.pop(digest, None)
+
+    def store(self, url, content, etag=None, last_modified=None):
+        '''
+        write body to the cache and record its validators
+        '''
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        return self.store_file(url, tmp_path, hashlib.sha256(content).hexdigest(), len(content), etag, last_modified)
+
+    def store_file(self, url, tmp_path, digest, size, etag=None, last_modified=None, pin=False):
+        '''
+        move an already written body (e.g. a streamed download in self.root) into the cache
+        pin: keep the blob from being evicted until unpin(path) is called
+        returns: path of the stored blob
+        '''
+        path = self.blob_path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            os.remove(tmp_path)
+        else:
+            os.replace(tmp_path, path)
+
+        with self._lock:
+            self._index[url] = {
+                'sha256': digest,
+                'size': size,
+                'etag': etag,
+                'last_modified': last_modified,
+                'last_access': time.time(),
+            }
+            if pin:
+                self._pin(digest)
+            self._evict()
+            self._dirty = True #written by save(), see touch()
+
+        return path
+
+    def _evict(self):
+        #sizes are counted per blob since identical bodies are shared between urls,
+        #pinned blobs are still in use by the caller and are skipped (the cache can briefly exceed max_bytes)
+        blob_sizes = {e['sha256']: e['size'] for e in self._index.values()}
+        total = sum(blob_sizes.values())
+        if total <= self.max_bytes:
+            return
+
+        for url, entry in sorted(self._index.items(), key=lambda kv: kv[1]['last_access']):
+            if total <= self.max_bytes:
+                break
+            digest = entry['sha256']
+            if digest in self._pins:
+                continue
+            del self._index[url]
+            if any(e['sha256'] == digest for e in self._index.values()):
+                continue
+            total -= entry['size']
+            try:
+                os.remove(self.blob_path(digest))
+            except FileNotFoundError:
+                pass
+            print(f'cache: evicted {url}')
+
+    def size(self):
+        with self._lock:
+            return sum({e['sha256']: e['size'] for e in self._index.values()}.values())
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Shared HTTP helpers for the projections scraper:
+# pooled keep-alive sessions with per-host concurrency and rate limits,
+# backed by an optional on-disk DownloadCache
+
+import os
+import time
+import hashlib
+import tempfile
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class HostRateLimiter:
+    '''
+    caps the number of in-flight requests and the request rate for each host
+    max_concurrency: max simultaneous requests per host
+    rate_limit: max requests started per second per host (None or 0 disables)
+    '''
+
+    def __init__(self, max_concurrency=4, rate_limit=5.0):
+        self.max_concurrency = max_concurrency
+        self.min_interval = 1.0 / rate_limit if rate_limit else 0.0
+        self._lock = threading.Lock()
+        self._semaphores = {}
+        self._next_slot = {}
+
+    def _semaphore(self, host):
+        with self._lock:
+            if host not in self._semaphores:
+                self._semaphores[host] = threading.BoundedSemaphore(self.max_concurrency)
+            return self._semaphores[host]
+
+    def _wait_for_slot(self, host):
+        #reserve the next start time for this host, then sleep until it arrives
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot.get(host, now))
+            self._next_slot[host] = slot + self.min_interval
+        delay = slot - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    @contextmanager
+    def limit(self, url):
+        host = urlparse(url).netloc
+        with self._semaphore(host):
+            self._wait_for_slot(host)
+            yield
+
+
+class Downloader:
+    '''
+    thread-safe http client for the scraper
+    each worker thread gets its own keep-alive requests.Session, and every request
+    goes through a shared HostRateLimiter
+    cache: optional DownloadCache used by fetch() for conditional requests
+    '''
+
+    def __init__(self, max_concurrency=4, rate_limit=5.0, timeout=60, cache=None):
+        self.limiter = HostRateLimiter(max_concurrency, rate_limit)
+        self.cache = cache
+        self.timeout = timeout
+        self._pool_size = max_concurrency
+        self._local = threading.local()
+
+    @property
+    def session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self._pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self._local.session = session
+        return session
+
+    def get(self, url, **kwargs):
+        '''
+        rate limited GET using the calling thread's session
+        returns: requests.Response
+        '''
+        kwargs.setdefault('timeout', self.timeout)
+        with self.limiter.limit(url):
+            return self.session.get(url, **kwargs)
+
+    def head(self, url, **kwargs):
+        '''
+        rate limited HEAD (following redirects) using the calling thread's session
+        returns: requests.Response
+        '''
+        kwargs.setdefault('timeout', self.timeout)
+        kwargs.setdefault('allow_redirects', True)
+        with self.limiter.limit(url):
+            return self.session.head(url, **kwargs)
+
+    def fetch(self, url):
+        '''
+        returns: response body as bytes, or None if the server did not return a 2xx
+        '''
+        status, content = self.fetch_with_status(url)
+        return content
+
+    def fetch_with_status(self, url):
+        '''
+        like fetch(), but also returns the http status so callers can tell a 404 from other failures
+        with a cache, known urls are revalidated with If-None-Match/If-Modified-Since and
+        a 304 is served from disk. in offline mode only the cache is consulted
+        returns: (status_code, content), status_code is None for an offline cache miss
+        '''
+        cache = self.cache
+        if cache is None:
+            r = self.get(url)
+            if not r.ok:
+                return r.status_code, None
+            return r.status_code, r.content
+
+        if cache.offline:
+            content = cache.read(url)
+            return (200 if content is not None else None), content
+
+        r = self.get(url, headers=cache.validators(url))
+        if r.status_code == 304:
+            content = cache.read(url)
+            if content is not None:
+                return 200, content
+            r = self.get(url) #cache entry disappeared between validators() and read()
+
+        if not r.ok:
+            return r.status_code, None
+
+        cache.misses += 1
+        cache.store(url, r.content, etag=r.headers.get('ETag'), last_modified=r.headers.get('Last-Modified'))
+        return r.status_code, r.content
+
+    def _spool(self, r, f, chunk_size):
+        sha = hashlib.sha256()
+        size = 0
+        for chunk in r.iter_content(chunk_size=chunk_size):
+            f.write(chunk)
+            sha.update(chunk)
+            size += len(chunk)
+        return sha.hexdigest(), size
+
+    @contextmanager
+    def download(self, url, chunk_size=1024**2, validators=None):
+        '''
+        stream a (large) file to disk in chunks instead of holding it in memory
+        with a cache the body is written straight into the cache and the cached file is yielded,
+        pinned so it cannot be evicted before the context exits; otherwise a temp file is used
+        and removed on exit
+        validators: optional dict, filled with the etag and last_modified of the file
+            (from the response, or from the cache entry when the file is served from the cache)
+        yields: local file path, or None if the file could not be fetched
+        '''
+        cache = self.cache
+        if validators is None:
+            validators = {}
+
+        def cached_validators():
+            entry = cache.lookup(url) or {}
+            validators.update(etag=entry.get('etag'), last_modified=entry.get('last_modified'))
+
+        if cache is not None and cache.offline:
+            cached_validators()
+            with self._pinned(cache.path(url, pin=True)) as path:
+                yield path
+            return
+
+        headers = cache.validators(url) if cache is not None else {}
+        r = self.get(url, headers=headers, stream=True)
+        try:
+            if r.status_code == 304:
+                path = cache.path(url, pin=True)
+                if path is not None:
+                    cached_validators()
+                    with self._pinned(path):
+                        yield path
+                    return
+                r.close()
+                r = self.get(url, stream=True) #cache entry disappeared between validators() and path()
+
+            if not r.ok:
+                yield None
+                return
+            validators.update(etag=r.headers.get('ETag'), last_modified=r.headers.get('Last-Modified'))
+
+            tmp_dir = cache.root if cache is not None else None
+            fd, tmp_path = tempfile.mkstemp(dir=tmp_dir, suffix='.part')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    digest, size = self._spool(r, f, chunk_size)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+        finally:
+            r.close()
+
+        if cache is None:
+            try:
+                yield tmp_path
+            finally:
+                os.remove(tmp_path)
+            return
+
+        cache.misses += 1
+        path = cache.store_file(url, tmp_path, digest, size, pin=True, **validators)
+        with self._pinned(path):
+            yield path
+
+    @contextmanager
+    def _pinned(self, path):
+        #unpin a cache blob pinned by download() when its context exits
+        try:
+            yield path
+        finally:
+            if path is not None:
+                self.cache.unpin(path)
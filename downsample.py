@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Series downsampling for the dashboard figures.
+# Uses Largest-Triangle-Three-Buckets (Steinarsson, 2013), which keeps the points that define the
+# visual shape of a line (peaks, troughs) rather than every nth point.
+
+import numpy as np
+import pandas as pd
+
+def lttb(x, y, n_out):
+    '''
+    x, y: 1d float arrays, sorted by x
+    n_out: number of points to keep, the first and last point are always kept
+    returns: indices of the kept points in increasing order (all indices if len(x) <= n_out)
+    '''
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    #n_out - 2 buckets between the fixed first and last points
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    idx = np.empty(n_out, dtype=np.int64)
+    idx[0], idx[-1] = 0, n - 1
+
+    a = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        next_start = edges[i + 1]
+        next_end = edges[i + 2] if i + 2 < n_out - 1 else n
+        avg_x = x[next_start:next_end].mean()
+        avg_y = y[next_start:next_end].mean()
+
+        #pick the point of this bucket that forms the largest triangle with the last kept point and the next bucket's average
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(np.argmax(area))
+        idx[i + 1] = a
+
+    return idx
+
+def downsample_series(df, group_col, x_col, y_col, max_points, x_range=None):
+    '''
+    reduce every series (group of group_col) to at most max_points with lttb
+    x_col: datetime column the series are plotted against
+    x_range: optional (start, end) of the visible x-axis, points outside it are dropped except for
+        one on each side so lines still run to the edge of the plot
+    returns: frame with the kept rows, groups in their original order
+    '''
+    if x_range is not None:
+        x0, x1 = (pd.Timestamp(v).value for v in x_range)
+
+    parts = []
+    for _, g in df.groupby(group_col, sort=False):
+        g = g.sort_values(x_col)
+        x = g[x_col].values.astype('datetime64[ns]').astype('int64')
+
+        if x_range is not None:
+            lo = max(np.searchsorted(x, x0, side='left') - 1, 0)
+            hi = np.searchsorted(x, x1, side='right') + 1
+            g, x = g.iloc[lo:hi], x[lo:hi]
+
+        if len(g) > max_points:
+            y = g[y_col].values.astype('float64')
+            g = g.iloc[lttb(x.astype('float64'), y, max_points)]
+        parts.append(g)
+
+    if not parts:
+        return df
+    return pd.concat(parts)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# In-process LRU cache for dashboard query results.
+# Entries are dropped as soon as new model versions are loaded, detected through a cheap
+# data version query (max(model_date) in projections) that runs at most once per check_interval.
+
+import time
+import threading
+from collections import OrderedDict
+
+
+class FilterCache:
+    '''
+    bounded LRU cache of dataframes
+    data_version: callable returning a value that changes whenever the underlying table changes
+    maxsize: max number of cached results
+    check_interval: seconds between data_version checks
+    '''
+
+    def __init__(self, data_version, maxsize=64, check_interval=60):
+        self.data_version = data_version
+        self.maxsize = maxsize
+        self.check_interval = check_interval
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = None
+        self._checked_at = 0.0
+
+    def _check_version(self):
+        now = time.time()
+        if now - self._checked_at < self.check_interval:
+            return
+        self._checked_at = now
+        version = self.data_version()
+        if version != self._version:
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self._version = version
+
+    def get(self, key, load):
+        '''
+        returns: a copy of the cached result for key, calling load() on a miss
+        '''
+        with self._lock:
+            self._check_version()
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key].copy()
+            self.misses += 1
+            version = self._version
+
+        df = load()
+
+        with self._lock:
+            if version == self._version: #don't cache results loaded across an invalidation
+                self._entries[key] = df
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+        return df.copy()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._checked_at = 0.0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'data_version': str(self._version),
+            }
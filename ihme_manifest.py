@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Persisted manifest of IHME archives already ingested.
+# Stores the size, sha256 and http validators of every archive url we have processed, plus the
+# link list of the last downloads page we parsed, so get_ihme_df only downloads archives that are
+# new or that IHME re-published with different contents.
+
+import os
+import json
+import time
+import hashlib
+import tempfile
+import threading
+
+
+class IhmeManifest:
+    '''
+    archives: url -> {'size', 'sha256', 'etag', 'last_modified', 'model_version', 'seen_at'}
+    page: {'sha256', 'links'} of the last parsed downloads page
+    '''
+
+    def __init__(self, path=os.path.join('data', 'ihme_manifest.json')):
+        self.path = path
+        self._lock = threading.Lock()
+        self.archives = {}
+        self.page = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+            self.archives = data.get('archives', {})
+            self.page = data.get('page', {})
+
+    def __len__(self):
+        return len(self.archives)
+
+    def __contains__(self, url):
+        return url in self.archives
+
+    def cached_links(self, page_content):
+        '''
+        returns: the link list parsed from an identical page on an earlier run, or None
+        '''
+        if self.page.get('sha256') == hashlib.sha256(page_content).hexdigest():
+            return list(self.page['links'])
+        return None
+
+    def record_page(self, page_content, links):
+        self.page = {'sha256': hashlib.sha256(page_content).hexdigest(), 'links': list(links)}
+
+    def is_changed(self, url, size=None, etag=None, last_modified=None):
+        '''
+        compare what a HEAD request reports with the manifest entry
+        only validators known on both sides are compared, a url that was never seen counts as changed
+        '''
+        entry = self.archives.get(url)
+        if entry is None:
+            return True
+        for key, value in (('size', size), ('etag', etag), ('last_modified', last_modified)):
+            if value is not None and entry.get(key) is not None and str(entry[key]) != str(value):
+                return True
+        return False
+
+    def record(self, url, path=None, model_version=None, etag=None, last_modified=None):
+        '''
+        record an archive, hashing the downloaded file at path if given
+        returns: True if the contents differ from the previously recorded ones
+        '''
+        entry = {'seen_at': time.time(), 'etag': etag, 'last_modified': last_modified,
+                 'model_version': model_version, 'size': None, 'sha256': None}
+        if path is not None:
+            sha = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024**2), b''):
+                    sha.update(chunk)
+            entry['sha256'] = sha.hexdigest()
+            entry['size'] = os.path.getsize(path)
+
+        with self._lock:
+            previous = self.archives.get(url)
+            self.archives[url] = entry
+        return previous is None or previous.get('sha256') != entry['sha256']
+
+    def save(self):
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path) or '.', suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'archives': self.archives, 'page': self.page}, f, indent=1)
+            os.replace(tmp_path, self.path)
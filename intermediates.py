@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Typed columnar storage for the scraper's intermediate data
+# (compiled LANL/IHME downloads and merged projections).
+# Data is written as parquet with dictionary encoded labels and float32 metrics,
+# so later stages can load only the columns they need without re-parsing text.
+# Each dataset is an append-only PartitionedStore keyed by model version,
+# so each run only processes new forecasts.
+
+import os
+import re
+import json
+import hashlib
+import tempfile
+import threading
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from plot_option_data import csv_dtypes
+
+# low cardinality labels, stored dictionary encoded
+category_columns = ['location_name', 'model_version', 'model_name', 'fcst_date']
+date_columns = ['date', 'dates']
+
+def apply_dtypes(df):
+    '''
+    coerce an intermediate frame to its storage types
+    metrics listed in csv_dtypes become float32, other numeric columns (e.g. raw LANL
+    cumulative quantiles, which are differenced later) keep their precision
+    returns: dataframe
+    '''
+    for c in df.columns:
+        if c in category_columns:
+            df[c] = df[c].astype('str').where(df[c].notna()).astype('category')
+        elif c in date_columns:
+            df[c] = pd.to_datetime(df[c])
+        elif csv_dtypes.get(c) == 'float32':
+            df[c] = pd.to_numeric(df[c], errors='coerce').astype('float32')
+        elif df[c].dtype == np.object_:
+            #columns can be inferred as numbers in one source file and text in another
+            df[c] = df[c].where(df[c].isna(), df[c].astype('str'))
+    return df
+
+class PartitionedStore:
+    '''
+    append-only parquet store with one file per partition (e.g. per model version)
+    data/store/{name}/_manifest.json records every partition and which consumers
+    (pipeline stages such as 'merge' or 'load') have already processed it, so each stage
+    only reads the partitions added since its last successful run
+    '''
+
+    def __init__(self, name, root=os.path.join('data', 'store')):
+        self.name = name
+        self.path = os.path.join(root, name)
+        self._manifest_path = os.path.join(self.path, '_manifest.json')
+        os.makedirs(self.path, exist_ok=True)
+        self._lock = threading.Lock()
+        self.manifest = {'partitions': {}}
+        if os.path.exists(self._manifest_path):
+            with open(self._manifest_path) as f:
+                self.manifest = json.load(f)
+
+    @property
+    def partitions(self):
+        return self.manifest['partitions']
+
+    def _save_manifest(self):
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.manifest, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self._manifest_path)
+
+    def _file(self, key):
+        return os.path.join(self.path, 'part-' + re.sub(r'[^\w.-]', '_', key) + '.parquet')
+
+    def __contains__(self, key):
+        return key in self.partitions
+
+    def write(self, df, partition_by, overwrite=False, info=None):
+        '''
+        split df on partition_by (a column name or a series of keys aligned with df)
+        and write every partition that is not stored yet (or every partition if overwrite)
+        info: optional dict of partition key -> extra fields recorded in its manifest entry
+        returns: list of partition keys written
+        '''
+        if isinstance(partition_by, str):
+            partition_by = df[partition_by]
+
+        written = []
+        for key, part in df.groupby(partition_by.astype('str'), sort=True):
+            if key in self and not overwrite:
+                continue
+            path = self._file(key)
+            part = apply_dtypes(part.reset_index(drop=True))
+            part.to_parquet(path, index=False)
+            self.partitions[key] = {
+                'file': os.path.basename(path),
+                'rows': len(part),
+                'bytes': int(part.memory_usage(deep=True).sum()),
+                'added_at': datetime.utcnow().isoformat(),
+                'consumers': [],
+            }
+            if info and key in info:
+                self.partitions[key].update(info[key])
+            written.append(key)
+
+        if written:
+            self._save_manifest()
+        print(f'{self.name}: wrote {len(written)} new partitions')
+        return written
+
+    def pending(self, consumer):
+        '''
+        returns: sorted partition keys not yet processed by consumer
+        '''
+        return sorted(k for k, p in self.partitions.items() if consumer not in p['consumers'])
+
+    def mark_done(self, consumer, keys):
+        with self._lock:
+            for key in keys:
+                if consumer not in self.partitions[key]['consumers']:
+                    self.partitions[key]['consumers'].append(consumer)
+            self._save_manifest()
+
+    def fingerprint(self):
+        '''
+        returns: hash of the stored partitions (ignores which consumers have processed them)
+        '''
+        contents = sorted((k, p['rows'], p['added_at']) for k, p in self.partitions.items())
+        return hashlib.sha256(json.dumps(contents).encode('utf8')).hexdigest()
+
+    def partition_bytes(self, key):
+        '''
+        returns: in-memory size of a partition as recorded when it was written (0 if not stored)
+        '''
+        if key not in self:
+            return 0
+        partition = self.partitions[key]
+        return partition.get('bytes', partition['rows'] * 200) #rough estimate for partitions written before sizes were recorded
+
+    def read(self, keys=None, columns=None):
+        '''
+        load the given partitions (default: all) into one dataframe
+        returns: dataframe, or None if there is nothing to read
+        '''
+        if keys is None:
+            keys = sorted(self.partitions)
+        frames = [pd.read_parquet(os.path.join(self.path, self.partitions[k]['file']), columns=columns)
+                  for k in keys if k in self]
+        if not frames:
+            return None
+        return apply_dtypes(pd.concat(frames, ignore_index=True))
+
+def chunk_keys(keys, sizes, max_bytes):
+    '''
+    split keys into consecutive chunks whose summed sizes stay under max_bytes
+    (a single key larger than max_bytes gets a chunk of its own)
+    yields: lists of keys
+    '''
+    chunk, chunk_bytes = [], 0
+    for key in keys:
+        if chunk and chunk_bytes + sizes[key] > max_bytes:
+            yield chunk
+            chunk, chunk_bytes = [], 0
+        chunk.append(key)
+        chunk_bytes += sizes[key]
+    if chunk:
+        yield chunk
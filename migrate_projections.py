@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Schema migrations for the projections table, tuned to the dashboard's filter_df query
+# (location_name =, model_name IN, model_date BETWEEN, date >, ORDER BY date).
+#
+# index:     composite index on (location_name, model_name, model_date, date) that also carries the
+#            non-metric output columns, plus optionally the most used metric columns for index-only scans
+# partition: rebuilds projections as a table range-partitioned by model_date (one partition per month),
+#            so a query for a model_date window only touches the partitions it overlaps
+#
+# usage: python migrate_projections.py index [--include-metric deaths_mean ...]
+#        python migrate_projections.py partition [--months-ahead 3] [--drop-old]
+
+import argparse
+from datetime import date
+
+import pandas as pd
+from sqlalchemy import create_engine, text
+
+from config import app_config
+
+index_key = ['location_name', 'model_name', 'model_date', 'date']
+index_include = ['model_version', 'location_abbr']
+primary_key = ['location_name', 'date', 'model_date', 'model_name']
+
+def filter_index_name(table_name):
+    return f'{table_name}_filter_idx'
+
+def is_partitioned(conn, table_name):
+    return conn.execute(
+        text("SELECT EXISTS (SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid "
+             "WHERE c.relname = :t AND pg_table_is_visible(c.oid))"),
+        {'t': table_name}
+    ).scalar()
+
+def create_filter_index(engine, table_name, include_metrics=(), concurrently=True):
+    '''
+    create the covering index for filter_df (postgres 11+ for INCLUDE)
+    include_metrics: metric columns to add to INCLUDE so those metrics are served by index-only scans
+    concurrently: build without blocking writes, not supported on a partitioned parent and ignored there
+    '''
+    include = index_include + [m for m in include_metrics if m not in index_include]
+    key_list = ', '.join(f'"{c}"' for c in index_key)
+    include_list = ', '.join(f'"{c}"' for c in include)
+
+    with engine.connect() as conn:
+        concurrently = concurrently and not is_partitioned(conn, table_name)
+
+    #CREATE INDEX CONCURRENTLY cannot run inside a transaction block
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        conn.execute(text(
+            f"CREATE INDEX {'CONCURRENTLY ' if concurrently else ''}IF NOT EXISTS {filter_index_name(table_name)} "
+            f"ON {table_name} ({key_list}) INCLUDE ({include_list})"
+        ))
+        conn.execute(text(f'ANALYZE {table_name}'))
+    print(f'created index {filter_index_name(table_name)} on {table_name} ({key_list}) INCLUDE ({include_list})')
+
+def month_starts(start, end):
+    '''
+    first day of every month from the month of start through the month of end
+    '''
+    return list(pd.date_range(pd.Timestamp(start).replace(day=1), pd.Timestamp(end), freq='MS').date)
+
+def partition_name(table_name, month):
+    return f'{table_name}_y{month.year}m{month.month:02d}'
+
+def create_month_partitions(conn, table_name, start, end):
+    '''
+    create the monthly model_date partitions of table_name covering start through end (existing ones are kept)
+    returns: number of partitions created
+    '''
+    created = 0
+    for month in month_starts(start, end):
+        next_month = (pd.Timestamp(month) + pd.offsets.MonthBegin(1)).date()
+        name = partition_name(table_name, month)
+        exists = conn.execute(text('SELECT to_regclass(:t) IS NOT NULL'), {'t': name}).scalar()
+        if not exists:
+            conn.execute(text(
+                f"CREATE TABLE {name} PARTITION OF {table_name} FOR VALUES FROM ('{month}') TO ('{next_month}')"
+            ))
+            created += 1
+    return created
+
+def ensure_partitions(engine, table_name, start, end, months_ahead=1):
+    '''
+    make sure monthly partitions exist for model dates start through end (+ months_ahead),
+    no-op if table_name is not partitioned. rows outside every partition land in the default partition,
+    which would block creating their month later, so loaders call this before inserting
+    '''
+    end = (pd.Timestamp(end) + pd.DateOffset(months=months_ahead)).date()
+    with engine.begin() as conn:
+        if not is_partitioned(conn, table_name):
+            return 0
+        created = create_month_partitions(conn, table_name, start, end)
+    if created:
+        print(f'created {created} model_date partitions of {table_name}')
+    return created
+
+def partition_table(engine, table_name, months_ahead=3, drop_old=False):
+    '''
+    rebuild table_name as a table range-partitioned by model_date, copying every row
+    the swap happens in a single transaction; the old table is kept as {table_name}_unpartitioned
+    unless drop_old is set
+    '''
+    new_table = f'{table_name}_partitioned'
+    old_table = f'{table_name}_unpartitioned'
+    key_list = ', '.join(f'"{c}"' for c in primary_key)
+
+    with engine.begin() as conn:
+        if is_partitioned(conn, table_name):
+            print(f'{table_name} is already partitioned')
+            return
+
+        bounds = conn.execute(text(f'SELECT MIN(model_date), MAX(model_date) FROM {table_name}')).fetchone()
+        start = bounds[0] or date.today()
+        end = (pd.Timestamp(bounds[1] or date.today()) + pd.DateOffset(months=months_ahead)).date()
+
+        #the partition key must be part of the primary key, which model_date already is
+        conn.execute(text(f'CREATE TABLE {new_table} (LIKE {table_name} INCLUDING DEFAULTS) PARTITION BY RANGE (model_date)'))
+        conn.execute(text(f'ALTER TABLE {new_table} ADD PRIMARY KEY ({key_list})'))
+        created = create_month_partitions(conn, new_table, start, end)
+        conn.execute(text(f'CREATE TABLE {new_table}_default PARTITION OF {new_table} DEFAULT'))
+
+        rows = conn.execute(text(f'INSERT INTO {new_table} SELECT * FROM {table_name}')).rowcount
+
+        conn.execute(text(f'ALTER TABLE {table_name} RENAME TO {old_table}'))
+        conn.execute(text(f'ALTER TABLE {new_table} RENAME TO {table_name}'))
+        conn.execute(text(f'ALTER TABLE {new_table}_default RENAME TO {table_name}_default'))
+        for month in month_starts(start, end):
+            conn.execute(text(f'ALTER TABLE {partition_name(new_table, month)} RENAME TO {partition_name(table_name, month)}'))
+        if drop_old:
+            conn.execute(text(f'DROP TABLE {old_table}'))
+
+    print(f'partitioned {table_name} by model_date: {rows} rows in {created} monthly partitions'
+          + ('' if drop_old else f', old table kept as {old_table}'))
+
+def migrate(engine, table_name, steps, include_metrics=(), months_ahead=3, drop_old=False):
+    if 'partition' in steps:
+        partition_table(engine, table_name, months_ahead=months_ahead, drop_old=drop_old)
+    if 'index' in steps:
+        create_filter_index(engine, table_name, include_metrics=include_metrics)
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='index and partition the projections table for the dashboard queries')
+    parser.add_argument('steps', nargs='+', choices=['index', 'partition'],
+                        help='migrations to run, partition always runs before index')
+    parser.add_argument('--include-metric', action='append', default=[],
+                        help='metric column to add to the covering index (repeatable)')
+    parser.add_argument('--months-ahead', type=int, default=3, help='empty monthly partitions to create past the newest model_date (default: 3)')
+    parser.add_argument('--drop-old', action='store_true', help='drop the unpartitioned table after the swap')
+    parser.add_argument('--db-uri', default=app_config['sqlalchemy_database_uri'])
+    parser.add_argument('--table', default=app_config['database_name'])
+    args = parser.parse_args()
+
+    engine = create_engine(args.db_uri)
+    migrate(engine, args.table, args.steps, include_metrics=args.include_metric,
+            months_ahead=args.months_ahead, drop_old=args.drop_old)
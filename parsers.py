@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Parsers for downloaded LANL csv files and IHME zip archives.
+# These live outside projections-scraper.py so they can run in a process pool:
+# workers import this module and hand back compact, typed frames.
+
+import os
+import zipfile
+
+from intermediates import apply_dtypes
+from source_schema import lanl_schema, ihme_schema, bytes_opener
+
+def parse_lanl_csv(content, metric):
+    '''
+    parse a downloaded LANL csv into the compiled column layout
+    only the lanl_schema columns are read, columns are renamed so they are consistent between all model versions
+    returns: dataframe
+    '''
+    df = lanl_schema.read_csv(bytes_opener(content), source=f'lanl {metric}')
+    return apply_dtypes(df)
+
+def read_ihme_archive(path, url, extract=False):
+    '''
+    read the projections csv straight out of an IHME zip archive
+    only the first csv member is decompressed unless extract is True, which also
+    unpacks the whole archive into data/ihme_archive
+    returns: dataframe
+    '''
+    with zipfile.ZipFile(path) as zf:
+        if extract:
+            zf.extractall(os.path.join('data','ihme_archive'))
+
+        model_folder = zf.namelist()[0][:-1] #drop trailing slash
+        
+        if '/' in model_folder:
+            model_folder = model_folder.split('/')[0]
+    
+        if model_folder != 'ihme-covid19': #parse from zip file folder name
+            model_version = model_folder
+        else: #parse from url folder name
+            model_version = url.split('/')[-2] 
+
+        print('processing:', model_version)
+
+        csv_name = next(file for file in zf.namelist() if file.endswith('.csv'))
+        #only the ihme_schema columns are materialized, date_reported is renamed to date
+        df = ihme_schema.read_csv(lambda: zf.open(csv_name), source=f'ihme {model_version}')
+
+    df['model_version'] = model_version
+
+    return apply_dtypes(df)
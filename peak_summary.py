@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Per-version peak summary for the dashboard stat cards.
+# For every (location, metric, model_name, model_version) the projection_peaks table holds the peak value,
+# the date it is reached and the model date. The scraper updates it for each model_date it loads, so the
+# cards are one primary key lookup instead of a group-by over the projections time series.
+#
+# usage: python peak_summary.py    (rebuild the summary for every model_date in projections)
+
+import pandas as pd
+from sqlalchemy import create_engine, text
+
+from catalog import numeric_columns
+from config import app_config
+
+peaks_table = 'projection_peaks'
+peak_keys = ['location_name', 'metric', 'model_name', 'model_version']
+peak_columns = peak_keys + ['model_date', 'peak_value', 'peak_date']
+
+def version_peaks(df, metrics=None):
+    '''
+    df: projections rows (location_name, date, model_name, model_version, model_date and metric columns)
+    metrics: metric columns to summarize, default all numeric columns
+    returns: frame of peak_columns, one row per (location, metric, model_name, model_version) with data;
+        ties go to the earliest date
+    '''
+    if metrics is None:
+        metrics = numeric_columns(df.columns)
+    keys = ['location_name', 'model_name', 'model_version', 'model_date']
+
+    df = df[df['date'] > '2020-02-15'].sort_values('date') #same cutoff as the dashboard query
+    long = df[keys + ['date'] + list(metrics)].melt(id_vars=keys + ['date'], value_vars=metrics, var_name='metric', value_name='peak_value')
+    long = long.dropna(subset=['peak_value'])
+    for c in ['location_name', 'model_name', 'model_version']:
+        long[c] = long[c].astype('str')
+
+    idx = long.groupby(peak_keys, sort=False)['peak_value'].idxmax()
+    peaks = long.loc[idx].rename(columns={'date': 'peak_date'})
+    return peaks[peak_columns].reset_index(drop=True)
+
+def upsert_peaks(engine, peaks):
+    '''
+    insert or replace rows of the summary table
+    '''
+    with engine.begin() as conn:
+        conn.execute(text(f'''
+            CREATE TABLE IF NOT EXISTS {peaks_table} (
+                location_name text, metric text, model_name text, model_version text,
+                model_date timestamp, peak_value real, peak_date timestamp,
+                PRIMARY KEY (location_name, metric, model_name, model_version)
+            )'''))
+        if peaks.empty:
+            return 0
+        rows = peaks.astype({'peak_value': 'float64'}).to_dict('records')
+        for row in rows:
+            row['model_date'] = pd.Timestamp(row['model_date']).to_pydatetime()
+            row['peak_date'] = pd.Timestamp(row['peak_date']).to_pydatetime()
+        conn.execute(text(f'''
+            INSERT INTO {peaks_table} ({', '.join(peak_columns)})
+            VALUES ({', '.join(':' + c for c in peak_columns)})
+            ON CONFLICT ({', '.join(peak_keys)}) DO UPDATE SET
+            model_date = excluded.model_date, peak_value = excluded.peak_value, peak_date = excluded.peak_date
+        '''), rows)
+    return len(rows)
+
+def read_peaks(engine, model, location, metric, start_date, end_date):
+    '''
+    summary rows for the dashboard filters, same selection as filter_df
+    returns: frame with model_name, model_version, model_date, peak_value, peak_date,
+        or None if the summary table has not been built
+    '''
+    query = f'''
+    SELECT model_name, model_version, model_date, peak_value, peak_date
+    FROM {peaks_table}
+    WHERE location_name = %s AND metric = %s
+    AND model_name IN ({','.join(['%s'] * len(model))})
+    AND model_date BETWEEN %s AND %s
+    ORDER BY model_date
+    '''
+    try:
+        return pd.read_sql_query(query, engine, params=(location, metric, *model, start_date, end_date),
+                                 parse_dates=['model_date', 'peak_date'])
+    except Exception as e:
+        print(f'peak summary unavailable: {e}')
+        return None
+
+def rebuild_peaks(engine, table_name='projections'):
+    '''
+    recompute the summary for every model_date in table_name, one model_date at a time
+    '''
+    model_dates = pd.read_sql_query(f'SELECT DISTINCT model_date FROM {table_name} ORDER BY model_date', engine).model_date
+    total = 0
+    for md in model_dates:
+        df = pd.read_sql_query(f'SELECT * FROM {table_name} WHERE model_date = %s', engine, params=(md,), parse_dates=['date', 'model_date'])
+        total += upsert_peaks(engine, version_peaks(df))
+        print(f'model_date: {md}, peaks: {total}')
+    return total
+
+if __name__ == "__main__":
+    engine = create_engine(app_config['sqlalchemy_database_uri'])
+    rebuild_peaks(engine, app_config['database_name'])
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Minimal resumable pipeline runner for the scraper.
+# Every stage has an input fingerprint; after a stage succeeds its fingerprint is written to
+# data/checkpoints/{stage}.json, and on the next run a stage whose fingerprint is unchanged is skipped.
+# Each run writes a json report with wall time, peak RSS and row counts per stage.
+
+import os
+import sys
+import json
+import time
+import hashlib
+import resource
+from datetime import datetime
+
+def fingerprint(*parts):
+    '''
+    stable hash of json serializable inputs
+    '''
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode('utf8')).hexdigest()
+
+def _reset_peak_rss():
+    #linux only: writing 5 to clear_refs resets VmHWM so the peak can be measured per stage
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def _peak_rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    #ru_maxrss is the peak over the whole process: kilobytes on linux, bytes on macOS
+    scale = 1024**2 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+def _children_peak_rss_mb():
+    scale = 1024**2 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale
+
+
+class Pipeline:
+    '''
+    runs stages in order, skipping stages whose inputs have not changed since they last succeeded
+    force: run every stage regardless of checkpoints
+    '''
+
+    def __init__(self, checkpoint_dir=os.path.join('data', 'checkpoints'),
+                 report_dir=os.path.join('data', 'run_reports'), force=False):
+        self.checkpoint_dir = checkpoint_dir
+        self.report_dir = report_dir
+        self.force = force
+        self.stages = []
+        self.report = {'started_at': datetime.utcnow().isoformat(), 'stages': []}
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        os.makedirs(report_dir, exist_ok=True)
+
+    def stage(self, name, fn, inputs):
+        '''
+        register a stage
+        fn: callable run with no arguments, returns the number of rows it produced (or None)
+        inputs: callable returning a fingerprint of the stage inputs, evaluated right before the
+            stage would run so it sees the output of earlier stages; None runs the stage every time
+            (for stages that find their own work, e.g. downloads)
+        '''
+        self.stages.append((name, fn, inputs))
+
+    def _checkpoint_path(self, name):
+        return os.path.join(self.checkpoint_dir, f'{name}.json')
+
+    def _checkpoint(self, name):
+        path = self._checkpoint_path(name)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def _write_checkpoint(self, name, inputs_fingerprint, entry):
+        with open(self._checkpoint_path(name), 'w') as f:
+            json.dump(dict(entry, fingerprint=inputs_fingerprint), f, indent=1)
+
+    def run(self):
+        '''
+        run all stages, stopping at the first failure (later reruns resume from the failed stage)
+        returns: path of the run report
+        '''
+        try:
+            for name, fn, inputs in self.stages:
+                inputs_fingerprint = inputs() if inputs is not None else None
+                checkpoint = self._checkpoint(name) if inputs is not None else None
+                entry = {'stage': name, 'fingerprint': inputs_fingerprint}
+
+                if not self.force and checkpoint is not None and checkpoint['fingerprint'] == inputs_fingerprint:
+                    print(f'[pipeline] {name}: inputs unchanged since {checkpoint["completed_at"]}, skipping')
+                    entry['status'] = 'skipped'
+                    self.report['stages'].append(entry)
+                    continue
+
+                print(f'[pipeline] {name}: running')
+                per_stage_peak = _reset_peak_rss()
+                start = time.time()
+                try:
+                    rows = fn()
+                except Exception as e:
+                    entry.update(status='failed', error=repr(e), wall_time_s=round(time.time() - start, 3))
+                    self.report['stages'].append(entry)
+                    raise
+
+                entry.update(
+                    status='completed',
+                    completed_at=datetime.utcnow().isoformat(),
+                    wall_time_s=round(time.time() - start, 3),
+                    peak_rss_mb=round(_peak_rss_mb(), 1),
+                    peak_rss_scope='stage' if per_stage_peak else 'process',
+                    children_peak_rss_mb=round(_children_peak_rss_mb(), 1),
+                    rows=rows,
+                )
+                self.report['stages'].append(entry)
+                if inputs is not None:
+                    self._write_checkpoint(name, inputs_fingerprint, entry)
+                print(f"[pipeline] {name}: {entry['wall_time_s']}s, peak rss {entry['peak_rss_mb']} MB, rows {rows}")
+        finally:
+            self.report['finished_at'] = datetime.utcnow().isoformat()
+            path = os.path.join(self.report_dir, f"run-{datetime.utcnow().strftime('%Y%m%dT%H%M%S_%f')}.json")
+            with open(path, 'w') as f:
+                json.dump(self.report, f, indent=1)
+            print(f'[pipeline] run report: {path}')
+
+        return path
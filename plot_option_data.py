@@ -1,4 +1,4 @@
-# data types for the merged_projections.csv file
+# data types for the merged_projections intermediate (also used for the other compiled intermediates)
 csv_dtypes = {'location_name': 'category',
  'date': 'datetime64[ns]',
  'allbed_mean': 'float32',
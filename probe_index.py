@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Persistent record of which forecast urls exist and which returned 404.
+# LANL only publishes a few times a week, so most (date, geo, metric) urls generated by
+# get_date_list never exist. Old misses are never probed again; misses for recent dates
+# are re-probed once their TTL expires in case a file was published late.
+
+import os
+import json
+import time
+import threading
+import tempfile
+from datetime import date, timedelta
+
+
+class ProbeIndex:
+    '''
+    url -> {'status': 'found' | 'missing', 'date': model date, 'checked_at': epoch seconds}
+    path: json file holding the index
+    recent_days: misses for model dates newer than this many days ago are re-probed, this should
+        cover LANL's publication lag but stay well inside the scraper's default 7 day window
+    ttl_hours: how long a recent miss is trusted before re-probing
+    '''
+
+    def __init__(self, path=os.path.join('data', 'lanl_probe_index.json'), recent_days=3, ttl_hours=12):
+        self.path = path
+        self.recent_days = recent_days
+        self.ttl = ttl_hours * 3600
+        self.skipped = 0
+        self._lock = threading.Lock()
+        self._index = {}
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self._index = json.load(f)
+            except ValueError:
+                print(f'warning: ignoring corrupt probe index {path}')
+
+    def should_probe(self, url, model_date):
+        '''
+        returns: False if url is a known miss that does not need to be re-checked
+        '''
+        entry = self._index.get(url)
+        if entry is None or entry['status'] != 'missing':
+            return True
+
+        cutoff = str(date.today() - timedelta(days=self.recent_days))
+        if model_date >= cutoff and time.time() - entry['checked_at'] > self.ttl:
+            return True
+
+        self.skipped += 1
+        return False
+
+    def record(self, url, model_date, status_code):
+        '''
+        store the probe result, only a 404 counts as a miss, other errors are not remembered
+        '''
+        if status_code is None:
+            return
+        if 200 <= status_code < 300:
+            status = 'found'
+        elif status_code == 404:
+            status = 'missing'
+        else:
+            return
+        with self._lock:
+            self._index[url] = {'status': status, 'date': model_date, 'checked_at': time.time()}
+
+    def counts(self):
+        found = sum(1 for e in self._index.values() if e['status'] == 'found')
+        return found, len(self._index) - found
+
+    def save(self):
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path) or '.', suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self._index, f)
+            os.replace(tmp_path, self.path)
@@ -7,243 +7,363 @@ from datetime import datetime, date, timedelta
 import argparse
 
 import pandas as pd
-import numpy as np
 from pangres import upsert
 
-import requests 
-from bs4 import BeautifulSoup
-
-import io
 import re
+import html
 import itertools
-import zipfile
-from sqlalchemy import create_engine
+from urllib.parse import urljoin
+import threading
+import multiprocessing
+from contextlib import ExitStack
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+from sqlalchemy import create_engine, text
 
 from column_translater import lanl_to_ihme_translator
 from region_abbreviations import us_state_abbrev
 from config import app_config
 from plot_option_data import csv_dtypes
+from downloader import Downloader
+from download_cache import DownloadCache
+from probe_index import ProbeIndex
+from ihme_manifest import IhmeManifest
+from intermediates import PartitionedStore, chunk_keys
+from bulk_load import copy_upsert
+from cumulative import grouped_diff
+from source_schema import ihme_ignored_columns
+from parsers import parse_lanl_csv, read_ihme_archive
+from pipeline import Pipeline, fingerprint
+from catalog import refresh_catalog
+from peak_summary import version_peaks, upsert_peaks
+from actuals import upsert_actuals
+from projections_cube import build_cube
+from migrate_projections import ensure_partitions
+
+#source locations, overridden by the offline benchmarks to point at a local server
+LANL_BASE_URL = 'https://covid-19.bsvgateway.org'
+IHME_DOWNLOADS_URL = 'http://www.healthdata.org/covid/data-downloads'
+
+class InlineExecutor:
+    '''
+    stand-in for ProcessPoolExecutor that runs each call immediately in this process
+    '''
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+def parse_executor(parse_workers):
+    '''
+    returns: a process pool for parse_workers > 1, otherwise an inline executor
+    '''
+    if parse_workers and parse_workers > 1:
+        #spawn rather than fork, the pool starts while download threads are running
+        return ProcessPoolExecutor(max_workers=parse_workers, mp_context=multiprocessing.get_context('spawn'))
+    return InlineExecutor()
 
-def get_date_list(min_date):
+def get_date_list(min_date, max_date=None):
     '''
-    generates list of dates from today backwards to min_date
+    generates list of dates from today (or max_date) backwards to min_date (exclusive)
+    min_date, max_date: YYYY-MM-DD strings or dates
     '''
     date_list = []
-    day = date.today()
-    while str(day) != min_date:
+    min_date = date.fromisoformat(str(min_date))
+    day = date.fromisoformat(str(max_date)) if max_date is not None else date.today()
+    while day > min_date:
         day_str = str(day)
         date_list.append(day_str)
         day = day - timedelta(days=1)
         
     return date_list
 
-def get_lanl_df(min_date=None):
+def lanl_url(date, metric, geo):
+    '''
+    builds the url of a LANL forecast file
+    returns: (fname, url)
+    '''
+
+    #LANL added _website suffix to files in their 2020-04-26 update
+    suffix = ''
+    if date >= '2020-04-26': 
+        suffix = '_website' 
+
+    #lanl changed their filenames after the 2020-10-28 update
+    if date <= '2020-10-28':
+        fname = f'{date}_{metric}_quantiles_{geo}{suffix}.csv'
+    else:
+        if metric == 'deaths':
+            fname = f'{date}_{geo}_cumulative_daily_deaths{suffix}.csv'
+        elif metric == 'confirmed':
+            fname = f'{date}_{geo}_cumulative_daily_cases{suffix}.csv'
+
+    url = f'{LANL_BASE_URL}/forecast/{geo}/{date}/files/{fname}'
+
+    return fname, url
+
+def get_lanl_df(min_date=None, workers=4, downloader=None, probe_index=None, parse_workers=1, max_date=None):
     '''
-    download lanl projections and compiles into one csv file
-    returns: None
+    download new lanl projections into the lanl_{metric} partitioned stores
+    each forecast date is published as a us and a global file, the store records which of them a
+    date's partition holds: files already stored are not downloaded again, and a date whose other
+    geo turns up later is rewritten with both
+    max_date: newest forecast date to download (default: today)
+    workers: number of concurrent download threads
+    parse_workers: number of processes parsing downloaded csvs (1 parses in this process)
+    downloader: Downloader used for all requests (sets per-host concurrency and rate limit)
+    probe_index: ProbeIndex of known missing urls, these are skipped instead of re-probed
+    returns: number of rows written
     '''
     
-    lanl_dates = get_date_list(min_date)
+    lanl_dates = get_date_list(min_date, max_date)
     lanl_metrics = ['deaths', 'confirmed']
+    lanl_geos = ['us', 'global']
+
+    if downloader is None:
+        downloader = Downloader()
+
+    rows = 0
+
+    def probe(file):
+        date, geo, fname, url = file
+        status, content = downloader.fetch_with_status(url)
+        if probe_index is not None:
+            probe_index.record(url, date, status)
+        return content
 
     for metric in lanl_metrics:
 
         df_list = []
+        store = PartitionedStore(f'lanl_{metric}')
+
+        def stored_geos(date):
+            if date not in store:
+                return set()
+            return set(store.partitions[date].get('geos', lanl_geos)) #partitions written before geos were recorded count as complete
+
+        files = [(date, geo) + lanl_url(date, metric, geo) for date in lanl_dates for geo in lanl_geos if geo not in stored_geos(date)]
+        if probe_index is not None:
+            files = [f for f in files if probe_index.should_probe(f[3], f[0])]
         
-        for date in lanl_dates:
-
-            #LANL added _website suffix to files in their 2020-04-26 update
-            
-            suffix = ''
-            if date >= '2020-04-26': 
-                suffix = '_website' 
-
-            for geo in ['us','global']:
-                #lanl changed their filenames after the 2020-10-28 update
-                if date <= '2020-10-28':
-                    fname = f'{date}_{metric}_quantiles_{geo}{suffix}.csv'
-                else:
-                    if metric == 'deaths':
-                        fname = f'{date}_{geo}_cumulative_daily_deaths{suffix}.csv'
-                    elif metric == 'confirmed':
-                        fname = f'{date}_{geo}_cumulative_daily_cases{suffix}.csv'
-                
-                url = f'https://covid-19.bsvgateway.org/forecast/{geo}/{date}/files/{fname}'
-                r = requests.get(url)
-
-                if r.ok:
-                    data = r.content.decode('utf8')
-                    tmp = pd.read_csv(io.StringIO(data))
-                    tmp['metric'] = metric
-                    #drop columns that are not consistent between all model versions
-                    drop_cols = ['simple_state','simple_countries','key','big_group','truth_confirmed','q.025','q.975']
-                    tmp.drop(columns=drop_cols, inplace=True, errors='ignore')
-                    #rename columns so they are consistent between all model versions
-                    rename_dict = {'state':'location_name','countries':'location_name','name':'location_name','date':'dates'}
-                    tmp.rename(columns=rename_dict, inplace=True)
-                    
-                    #subset and order final columns
-                    cols = [
-                        'dates','q.01','q.05','q.10','q.15','q.20','q.25',
-                        'q.30','q.35','q.40','q.45','q.50','q.55','q.60','q.65',
-                        'q.70','q.75','q.80','q.85','q.90','q.95','q.99',
-                        'obs','location_name','fcst_date'
-                    ]
-
-                    df_list.append(tmp[cols])
-                    print(f'lanl {date}: {fname} total: {len(df_list)}')
-
-
-                time.sleep(0.2) #pause between requests
-
-                    
+        #downloads run concurrently but results are consumed in date/geo order,
+        #so the stored partitions are identical to a serial run
+        found_geos = {}
+        with ThreadPoolExecutor(max_workers=workers) as executor, parse_executor(parse_workers) as parser:
+            contents = executor.map(probe, files)
+
+            for (date, geo, fname, url), content in zip(files, contents):
+                if content is not None:
+                    df_list.append(parser.submit(parse_lanl_csv, content, metric))
+                    found_geos.setdefault(date, set()).add(geo)
+                    print(f'lanl {fname} total: {len(df_list)}')
+
+            df_list = [f.result() for f in df_list]
+
+        if probe_index is not None:
+            probe_index.save()
         
         #merge and process data
         if len(df_list) > 0:
             df = pd.concat(df_list)
             df.columns = [c.replace('.','') for c in df.columns] #remove periods in quantile colnames
-            df.to_csv(os.path.join('data', f'lanl_{metric}_compiled.csv'), index=False)
+            rows += len(df)
+
+            #dates that already hold one geo are rewritten with the stored rows plus the new geo
+            stored = store.read([date for date in found_geos if date in store])
+            if stored is not None:
+                df = pd.concat([stored, df], ignore_index=True)
+            info = {date: {'geos': sorted(stored_geos(date) | geos)} for date, geos in found_geos.items()}
+            store.write(df, 'fcst_date', overwrite=True, info=info)
         else:
-            print('error: dataframe list is empty')
+            print(f'lanl {metric}: no new files')
+
+    return rows
 
-def get_ihme_filelist():
+#link-only parse of the downloads page, much cheaper than building a full BeautifulSoup tree
+paragraph_re = re.compile(r'<p\b[^>]*>(.*?)</p>', re.S | re.I)
+href_re = re.compile(r'<a\b[^>]*?\bhref\s*=\s*["\']([^"\']+)["\']', re.S | re.I)
+
+def parse_ihme_links(page):
+    '''
+    every link in paragraphs that link to an ihmecovid19storage archive, in page order
+    returns: list of hrefs
+    '''
+    file_list = []
+    for p in paragraph_re.findall(page):
+        hrefs = [html.unescape(h) for h in href_re.findall(p)]
+        if any('ihmecovid19storage' in h for h in hrefs):
+            file_list += hrefs
+    return file_list
+
+def get_ihme_filelist(downloader=None, manifest=None):
     '''
     parse IHME downloads page for links to zip files
+    manifest: IhmeManifest, the page is only re-parsed when its contents changed since the last run
     returns: list of zip file urls
     '''
     
-    url = 'http://www.healthdata.org/covid/data-downloads'
+    url = IHME_DOWNLOADS_URL
+
+    if downloader is None:
+        downloader = Downloader()
 
-    r = requests.get(url)
+    content = downloader.fetch(url)
+    if content is None:
+        print(f'error: could not fetch {url}')
+        return []
 
-    soup = BeautifulSoup(r.content, 'html.parser')
+    file_list = manifest.cached_links(content) if manifest is not None else None
+    if file_list is not None:
+        print('ihme downloads page unchanged since last run')
+        return file_list
 
-    file_list = [p.find_all('a') for p in soup.find_all('p') if p.find_all('a', href=re.compile('ihmecovid19storage')) != []] 
-    file_list = list(itertools.chain.from_iterable(file_list)) #join list of lists
-    file_list = [f['href'] for f in file_list] #get file url
+    file_list = parse_ihme_links(content.decode('utf8', errors='replace'))
     file_list.append(file_list.pop(0)) #insert latest list at end to ensure chronological order
-    file_list = ['http://www.healthdata.org' + f if '/sites/default/' in f else f for f in file_list] #append base url for files hosted on IHME website
+    file_list = [urljoin(url, f) if '/sites/default/' in f else f for f in file_list] #append base url for files hosted on IHME website
+
+    if manifest is not None:
+        manifest.record_page(content, file_list)
     
     return file_list
 
-def get_ihme_df(min_date=None):
+def select_ihme_archives(file_list, manifest, min_date=None, downloader=None, workers=4):
     '''
-    download ihme projections and compiles into one csv file
-    returns: None
+    diff the downloads page against the manifest
+    urls never seen are new regardless of min_date, except on the first run (empty manifest) where
+    archives outside the window are only recorded; known urls are checked with a HEAD request and
+    count as changed when their size or validators differ
+    returns: list of urls to download
     '''
-
-    df_list = []
-    
-    file_list = get_ihme_filelist()
-    if min_date != None:
+    if len(manifest) == 0 and min_date is not None:
+        for f in file_list:
+            if f.split('/')[-2] < min_date:
+                manifest.record(f)
         file_list = [f for f in file_list if f.split('/')[-2] >= min_date]
 
-    for f in file_list:
+    new = [f for f in file_list if f not in manifest]
+    known = [f for f in file_list if f in manifest]
 
-        r = requests.get(f, stream=True)
-        zf = zipfile.ZipFile(io.BytesIO(r.content))
-        zf.extractall(os.path.join('data','ihme_archive'))
+    def changed(f):
+        r = downloader.head(f)
+        if not r.ok:
+            return False
+        return manifest.is_changed(f, r.headers.get('Content-Length'), r.headers.get('ETag'), r.headers.get('Last-Modified'))
 
-        model_folder = zf.namelist()[0][:-1] #drop trailing slash
-        
-        if '/' in model_folder:
-            model_folder = model_folder.split('/')[0]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        changed_list = [f for f, c in zip(known, executor.map(changed, known)) if c]
+
+    print(f'ihme archives: {len(new)} new, {len(changed_list)} changed, {len(known) - len(changed_list)} unchanged')
+    return [f for f in file_list if f in set(new + changed_list)]
+
+def get_ihme_df(min_date=None, downloader=None, extract=False, parse_workers=1, manifest=None):
+    '''
+    download ihme projections into the ihme partitioned store
+    downloader: Downloader used for all requests (and its download cache, if any)
+    extract: also unpack every archive into data/ihme_archive
+    parse_workers: number of processes parsing downloaded archives (1 parses in this process)
+    manifest: IhmeManifest, when given only new or re-published archives are fetched (see select_ihme_archives)
+        and their partitions replace earlier ones
+    returns: dataframe of the archives processed, or None
+    '''
+
+    df_list = []
+    df = None
+
+    if downloader is None:
+        downloader = Downloader()
     
-        if model_folder != 'ihme-covid19': #parse from zip file folder name
-            model_version = model_folder
-        else: #parse from url folder name
-            model_version = f.split('/')[-2] 
-
-        print('processing:', model_version)
-
-        df = [pd.read_csv(zf.open(file)) for file in zf.namelist() if file.endswith('.csv')][0]
-        df.rename(columns={'date_reported':'date'}, inplace=True) #fix inconsistent column names
-        df['model_version'] = model_version
-     #     df = pd.read_csv(z.open('hospitalization_all_locs_corrected.csv'))
-        df_list.append(df)
-        
-        time.sleep(0.2)
+    file_list = get_ihme_filelist(downloader, manifest)
+    if manifest is not None:
+        file_list = select_ihme_archives(file_list, manifest, min_date, downloader)
+    elif min_date != None:
+        file_list = [f for f in file_list if f.split('/')[-2] >= min_date]
+
+    #downloaded archives stay on disk until every parse has finished
+    with ExitStack() as downloads, parse_executor(parse_workers) as parser:
+        for f in file_list:
+
+            #archives are spooled to disk in chunks rather than held in memory
+            validators = {}
+            path = downloads.enter_context(downloader.download(f, validators=validators))
+            if path is None:
+                print(f'error: could not fetch {f}')
+                continue
+            if manifest is not None and not manifest.record(f, path, model_version=f.split('/')[-2], **validators):
+                print(f'ihme archive unchanged after download: {f}')
+                continue
+            df_list.append(parser.submit(read_ihme_archive, path, f, extract=extract))
+
+        df_list = [f.result() for f in df_list]
         
     if len(df_list) > 0:
-        df = pd.concat(df_list).drop(columns=['V1','Unnamed: 0','location','location_id'], errors='ignore') #drop problematic columns if they exist in the df
-        df['location_name'] = np.where(df['location_name'] == 'US', 'United States of America', df['location_name']) 
-        df.to_csv(os.path.join('data','ihme_compiled.csv'), index=False)
+        df = pd.concat(df_list)
+        df['location_name'] = df['location_name'].astype('str').replace('US', 'United States of America')
+        store = PartitionedStore('ihme')
+        #re-published archives replace a stored partition: flag it so the loader replaces its rows too
+        replaced = {mv: {'replaced': True} for mv in df['model_version'].astype('str').unique() if mv in store}
+        store.write(df, 'model_version', overwrite=manifest is not None, info=replaced)
+
+    if manifest is not None:
+        manifest.save()
 
     return df
 
-def process_lanl_compiled(metric):
+def process_lanl_compiled(metric, fcst_dates):
     '''
     process lanl datasets for merge 
+    fcst_dates: partitions of the lanl_{metric} store to process
     '''
-    df = pd.read_csv(os.path.join('data',f'lanl_{metric}_compiled.csv'))
-
     lanl_keep_cols = ['dates','location_name','q05','q50','q95','fcst_date'] #TODO: using 90% CI (95/5). Is this consistent with IHME?
     lanl_index = ['fcst_date','location_name','dates']
     lanl_metrics = [c for c in lanl_keep_cols if 'q' == c[0]]
-    lanl_metrics_diff = [c+'_diff' for c in lanl_metrics]
-    df = df[lanl_keep_cols]
 
-    df = df.sort_values(lanl_index).reset_index(drop=True) #sort to allow diff
-    df[lanl_metrics_diff] =  df.sort_values(lanl_index)[lanl_metrics].diff()
+    df = PartitionedStore(f'lanl_{metric}').read(fcst_dates, columns=lanl_keep_cols)
+    if df is None:
+        df = pd.DataFrame(columns=lanl_keep_cols)
 
-    # LANL uses US instead of United States of America, let's make it match IHME
-    df.loc[df.location_name == "US", 'location_name'] = "United States of America"
+    print(df.shape, df.dropna(subset=lanl_index, how='all').shape, df.dropna(subset=lanl_index).shape)
+    df.dropna(subset=lanl_index, inplace=True) #for some reason 'location_name' and 'dates' columns can be na. this leads to an exploding join
 
-    #replace negative values caused by the diff crossing over states
-    for c in lanl_metrics_diff:
-        df[c] = np.where(df[c] < 0, 0, df[c])
+    #cumulative -> daily within each forecast/location, so the diff never crosses into another series
+    df = grouped_diff(df, ['fcst_date','location_name'], 'dates', lanl_metrics, first='nan')
+
+    # LANL uses US instead of United States of America, let's make it match IHME
+    df['location_name'] = df['location_name'].astype('str').replace('US', 'United States of America').astype('category')
 
     df.columns = [c if 'q' not in c else metric+'_'+c for c in df.columns] #add metric name to lanl metric columns
-    print(df.shape, df.dropna(subset=lanl_index, how='all').shape, df.dropna(subset=lanl_index).shape)
-    df.dropna(subset=lanl_index, inplace=True) #for some reason 'location_name' and 'dates' columns can be na. this leads to an exploding join
     df.set_index(lanl_index, inplace=True)
   
     return df
 
-def merge_projections():
+def merge_lanl_partitions(fcst_dates):
     '''
-    process and merge IHME / LANL data
+    merge LANL deaths and confirmed case data for the given forecast dates into IHME format
+    returns: dataframe
     '''
-
-    print('merging projection data...')
-    
-    #load and merge LANL deaths and confirmed case data
-    lanl_con = process_lanl_compiled('confirmed')
-    lanl_dea = process_lanl_compiled('deaths')
+    lanl_con = process_lanl_compiled('confirmed', fcst_dates)
+    lanl_dea = process_lanl_compiled('deaths', fcst_dates)
 
     lanl = lanl_dea.merge(lanl_con, right_index=True, left_index=True).reset_index()
     lanl.rename(columns=lanl_to_ihme_translator, inplace=True) #convert to IHME column names
     lanl['model_name'] = 'LANL'
 
-    print(f"processed lanl - memory: {lanl.memory_usage(deep=True)}")
-
-    #load IHME data
-    ihme = pd.read_csv(os.path.join('data','ihme_compiled.csv'))
-
-    #HACK: drop new IHME columns
-    ihme.drop(columns=['mobility_data_type','total_tests_data_type'], inplace=True)
-    new_ihme_columns = [
-        'mobility_composite','total_tests','confirmed_infections',
-        'est_infections_mean','est_infections_lower','est_infections_upper',
-        'deaths_mean_smoothed','deaths_lower_smoothed','deaths_upper_smoothed',
-        'totdea_mean_smoothed','totdea_lower_smoothed','totdea_upper_smoothed',
-        #more new columns
-        'total_pop', 
-        'deaths_mean_p100k_rate', 'deaths_lower_p100k_rate', 'deaths_upper_p100k_rate', 
-        'totdea_mean_p100k_rate', 'totdea_lower_p100k_rate', 'totdea_upper_p100k_rate', 
-        'deaths_mean_smoothed_p100k_rate', 'deaths_lower_smoothed_p100k_rate', 'deaths_upper_smoothed_p100k_rate', 
-        'totdea_mean_smoothed_p100k_rate', 'totdea_lower_smoothed_p100k_rate', 'totdea_upper_smoothed_p100k_rate', 
-        'confirmed_infections_p100k_rate', 'est_infections_mean_p100k_rate', 'est_infections_lower_p100k_rate', 
-        'est_infections_upper_p100k_rate', 
-        'inf_cuml_mean', 'inf_cuml_lower', 'inf_cuml_upper', 
-        'sero_pct', 'sero_pctlower', 'sero_pctupper', #column names may have changed for seroprevalence
-        'seroprev_mean', 'seroprev_upper', 'seroprev_lower',
-        #even more new columns
-        'deaths_data_type', 'confirmed_infections_data_type', 'est_infections_data_type', 
-        'seroprev_data_type', 
-        'observed' #this column may have been added then removed
-     ]
-    ihme.drop(columns=new_ihme_columns, inplace=True, errors='ignore')
+    return lanl
+
+def process_ihme_compiled(ihme):
+    '''
+    drop IHME columns and model versions that are not loaded into the projections table
+    returns: dataframe
+    '''
+    #partitions parsed before ihme_schema existed still carry every IHME column
+    ihme.drop(columns=ihme_ignored_columns, inplace=True, errors='ignore')
 
     #HACK: drop old IHME forecasts to save space
     drop_models = [
@@ -251,78 +371,115 @@ def merge_projections():
         '2020_03_30','2020_03_31.1','2020_04_01.2','2020_04_05.08.all','2020_04_07.06.all',
         '2020_04_09.06','2020_04_12.02'
     ]
-    ihme = ihme[~ihme.model_version.isin(drop_models)]
+    ihme = ihme[~ihme.model_version.isin(drop_models)].copy()
     ihme['model_name'] = 'IHME'
 
-    print(f"processed ihme - memory: {ihme.memory_usage(deep=True)}")
+    return ihme
 
-    #concatenate IHME and LANL data
-    merged = pd.concat([ihme, lanl], axis=0, ignore_index=True)
-    merged.to_csv(os.path.join('data','merged_projections.csv'), index=False)
+def write_merged(merged_store, merged, info=None):
+    '''
+    write merged rows with one partition per model_name/model_version
+    info: optional manifest fields per partition key (see PartitionedStore.write)
+    '''
+    partition_keys = merged['model_name'].astype('str') + '/' + merged['model_version'].astype('str')
+    merged_store.write(merged, partition_keys, overwrite=True, info=info)
 
-    print('merged data:', merged.shape)
+def merge_projections(max_memory_mb=512):
+    '''
+    process and merge IHME / LANL data
+    only partitions added since the last merge are processed, the result is written to
+    the merged store with one partition per model_name/model_version
+    max_memory_mb: model versions are processed in chunks whose stored size stays under this
+        ceiling, and each chunk is written out before the next one is loaded
+    '''
 
+    print('merging projection data...')
 
-def create_projections_table(min_date):
+    max_bytes = max_memory_mb * 1024**2
+    lanl_stores = [PartitionedStore(f'lanl_{metric}') for metric in ['confirmed', 'deaths']]
+    ihme_store = PartitionedStore('ihme')
+    merged_store = PartitionedStore('merged')
 
-    print('upserting db')
+    #a new forecast date in either metric means both metrics are re-read for that date
+    lanl_pending = sorted(set(itertools.chain.from_iterable(s.pending('merge') for s in lanl_stores)))
+    ihme_pending = ihme_store.pending('merge')
+    print(f'pending partitions - lanl: {lanl_pending}, ihme: {ihme_pending}')
 
-    # Make same changes as in the load_projections function
-    df = pd.read_csv(os.path.join('data','merged_projections.csv'), nrows=50)
-    
-    dtypes = [
-        'category','str',
-        'float32','float32','float32',
-        'float32','float32','float32',
-        'float32','float32','float32',
-        'float32','float32','float32',
-        'float32','float32','float32',
-        'float32','float32','float32',
-        'float32','float32','float32',
-        'float32','float32','float32',
-        'float32','float32','float32',
-        'category','category',
-        'float32','float32','float32',
-        'float32','float32','float32',
-    ]
+    if not lanl_pending and not ihme_pending:
+        print('no new partitions to merge')
+        return 0
+
+    total_rows = 0
+
+    lanl_sizes = {k: sum(s.partition_bytes(k) for s in lanl_stores) for k in lanl_pending}
+    for chunk in chunk_keys(lanl_pending, lanl_sizes, max_bytes):
+        lanl = merge_lanl_partitions(chunk)
+        print(f"processed lanl {chunk[0]}..{chunk[-1]} - memory: {lanl.memory_usage(deep=True).sum()}")
+        write_merged(merged_store, lanl)
+        total_rows += len(lanl)
+
+        for store in lanl_stores:
+            store.mark_done('merge', [k for k in chunk if k in store])
 
-    if len(df.columns) != len(dtypes):
-        print(f'len mismatch between df.columns ({len(df.columns)}) and dtypes ({len(dtypes)})')
-        print(df.info())
+    ihme_sizes = {k: ihme_store.partition_bytes(k) for k in ihme_pending}
+    for chunk in chunk_keys(ihme_pending, ihme_sizes, max_bytes):
+        ihme = process_ihme_compiled(ihme_store.read(chunk))
+        print(f"processed ihme {chunk[0]}..{chunk[-1]} - memory: {ihme.memory_usage(deep=True).sum()}")
+        replaced = {f'IHME/{k}': {'replaced': True} for k in chunk if ihme_store.partitions[k].get('replaced')}
+        write_merged(merged_store, ihme, info=replaced)
+        total_rows += len(ihme)
 
-    pd_dtypes = dict(zip(df.columns, dtypes))
+        ihme_store.mark_done('merge', chunk)
 
-    df = pd.read_csv(os.path.join('data','merged_projections.csv'), dtype=pd_dtypes)
-    df = df[df.model_version != '2020_04_05.05.us']
+    print('merged rows:', total_rows)
 
-    print(df.info(memory_usage='deep'))
-    print(df.columns)
+    return total_rows
 
-    df['date'] = pd.to_datetime(df['date'])
-    df['model_date'] = pd.to_datetime(df['model_version'].str[0:10].str.replace('_','-'))
-    df['location_abbr'] = df['location_name'].map(us_state_abbrev)
-    # df = df[df['model_date'] > (datetime.today() - timedelta(days=31))] # only loading model versions from the past 31 days
+
+def partition_model_date(key):
+    '''
+    model date of a merged store partition key (model_name/model_version)
+    '''
+    model_version = key.split('/', 1)[1]
+    return model_version[0:10].replace('_','-')
+
+summary_lock = threading.Lock() #serializes the peak summary and actuals updates of concurrent loaders
+
+def load_model_date(store, md, keys, method='upsert', staging_table=None):
+    '''
+    read the merged partitions for one model_date, upsert them into the projections table
+    and update their rows of the peak summary and actuals tables
+    returns: (rows inserted, rows skipped), skipped is unknown (None) for pangres upserts
+    '''
+    # merged partitions are stored with the csv_dtypes types, so no dtype guessing is needed here
+    dff = store.read(keys)
+    #partitions rewritten from a re-published archive replace the rows loaded from the old one
+    replace = [tuple(k.split('/', 1)) for k in keys if store.partitions[k].get('replaced')]
+
+    dff['date'] = pd.to_datetime(dff['date'])
+    dff['model_date'] = pd.to_datetime(dff['model_version'].str[0:10].str.replace('_','-'))
+    dff['location_abbr'] = dff['location_name'].map(us_state_abbrev)
+    peaks = version_peaks(dff)
+    observed = dff[dff['date'] <= dff['model_date']]
     index_col = ['location_name', 'date', 'model_date', 'model_name']
-    df.set_index(index_col,inplace= True)
-    df = df[~df.index.duplicated()]
+    dff.set_index(index_col,inplace= True)
+    if method == 'upsert':
+        dff = dff[~dff.index.duplicated()] #copy deduplicates in the database instead
     # drop old table and insert new table
     # df.to_sql(app_config['database_name'], con=engine, if_exists='replace', method='multi', chunksize=1000) #Todo: Do we want to specify data types in the table?
     # 'ALTER TABLE projections ADD PRIMARY KEY (location_name, date, model_date, model_name);'
-    # This upsert package requires us to name the index
-    # df.index.name = 'index'
-    
-    print('starting upsert')
-
-    #upsert by model_date rather than all at once
-    model_dates = df[df.index.get_level_values('model_date') >= min_date]\
-        .index.get_level_values('model_date').unique() #HACK! - hardcoded to do fill
-    print(model_dates)
     
-    for md in reversed(model_dates):
-        
-        dff = df[df.index.get_level_values('model_date') == md] 
-        print(f"model_date: {md}, model_names: {dff.index.get_level_values('model_name').astype('str').unique()}, memory: {dff.memory_usage(deep=True).sum()}")
-
+    print(f"model_date: {md}, model_names: {dff.index.get_level_values('model_name').astype('str').unique()}, memory: {dff.memory_usage(deep=True).sum()}")
+
+    if method == 'copy':
+        inserted, skipped = copy_upsert(engine, dff, app_config['database_name'], staging_table=staging_table, replace=replace)
+        print(f'model_date: {md}, inserted: {inserted}, skipped: {skipped}')
+    else:
+        if replace:
+            with engine.begin() as conn:
+                for model_name, model_version in replace:
+                    conn.execute(text(f"DELETE FROM {app_config['database_name']} WHERE model_name = :model_name AND model_version = :model_version"),
+                                 {'model_name': model_name, 'model_version': model_version})
         upsert(engine=engine,
             df=dff,
             table_name=app_config['database_name'],
@@ -330,19 +487,165 @@ def create_projections_table(min_date):
             add_new_columns=False,
             create_schema=False,
             adapt_dtype_of_empty_db_columns=False)
+        inserted, skipped = len(dff), None
+
+    #consecutive model_dates repeat almost all of their observed history, so concurrent loaders would
+    #update the same actuals rows in different orders and deadlock: the summary tables are updated one at a time
+    with summary_lock:
+        print(f'model_date: {md}, peaks: {upsert_peaks(engine, peaks)}, observed rows: {upsert_actuals(engine, observed)}')
+    return inserted, skipped
+
+def create_projections_table(min_date=None, method='upsert', workers=1, retries=2):
+    '''
+    upsert merged partitions that have not been loaded yet, one model_date at a time
+    min_date: optionally only load pending partitions with model_date >= min_date
+    method: 'upsert' uses pangres, 'copy' streams rows with COPY into a staging table and
+        lets postgres drop duplicate keys
+    workers: number of model_dates loaded concurrently, each worker holds one db connection and
+        reads its partitions only when it starts on them, so at most `workers` model_dates are in memory
+    retries: extra attempts for a model_date that fails, failed model_dates stay pending for the next run
+    returns: number of rows loaded
+    '''
+
+    print('upserting db')
+
+    store = PartitionedStore('merged')
+    pending = [k for k in store.pending('load') if k.split('/', 1)[1] != '2020_04_05.05.us']
+    if min_date is not None:
+        pending = [k for k in pending if partition_model_date(k) >= min_date]
+
+    #group pending partitions by model_date
+    model_dates = {}
+    for key in pending:
+        model_dates.setdefault(partition_model_date(key), []).append(key)
+    print(sorted(model_dates))
+    if model_dates:
+        #no-op unless the table was partitioned with migrate_projections.py
+        ensure_partitions(engine, app_config['database_name'], min(model_dates), max(model_dates))
+
+    print('starting upsert')
+    stats = {} #worker name -> [model_dates, rows, seconds]
+    stats_lock = threading.Lock()
+
+    def load(md):
+        worker = threading.current_thread().name
+        staging_table = f"{app_config['database_name']}_staging_{worker.rsplit('_', 1)[-1]}"
+        for attempt in range(retries + 1):
+            try:
+                start = time.time()
+                inserted, skipped = load_model_date(store, md, model_dates[md], method, staging_table)
+                break
+            except Exception as e:
+                print(f'model_date: {md}, attempt {attempt + 1} failed: {e}')
+                if attempt == retries:
+                    raise
+                time.sleep(2 ** attempt)
+
+        with stats_lock:
+            worker_stats = stats.setdefault(worker, [0, 0, 0.0])
+            worker_stats[0] += 1
+            worker_stats[1] += inserted
+            worker_stats[2] += time.time() - start
+        store.mark_done('load', model_dates[md])
+        return inserted, skipped
+
+    #upsert by model_date rather than all at once, newest first
+    total_inserted, total_skipped, failed = 0, 0, []
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='load') as executor:
+        futures = {md: executor.submit(load, md) for md in sorted(model_dates, reverse=True)}
+        for md, future in futures.items():
+            try:
+                inserted, skipped = future.result()
+            except Exception:
+                failed.append(md)
+                continue
+            total_inserted += inserted
+            total_skipped += skipped or 0
+
+    for worker, (n, rows, seconds) in sorted(stats.items()):
+        print(f'{worker}: {n} model_dates, {rows} rows in {seconds:.1f}s ({rows / max(seconds, 1e-9):.0f} rows/s)')
+    if method == 'copy':
+        print(f'bulk load: {total_inserted} rows inserted, {total_skipped} rows skipped')
+    if failed:
+        raise RuntimeError(f'failed to load model_dates {failed}, they will be retried on the next run')
+
+    return total_inserted
 
 if __name__ == "__main__":
 
-    min_date = str(date.today() - timedelta(days=7))
+    parser = argparse.ArgumentParser(description='download IHME/LANL projections and upsert them into the projections table')
+    parser.add_argument('--min-date', type=date.fromisoformat, default=date.today() - timedelta(days=7),
+                        help='oldest model date to download, YYYY-MM-DD (default: 7 days ago)')
+    parser.add_argument('--workers', type=int, default=4, help='concurrent download threads (default: 4)')
+    parser.add_argument('--parse-workers', type=int, default=1, help='processes used to parse downloaded files (default: 1)')
+    parser.add_argument('--max-per-host', type=int, default=4, help='max concurrent requests per host (default: 4)')
+    parser.add_argument('--rate-limit', type=float, default=5.0, help='max requests per second per host (default: 5)')
+    parser.add_argument('--no-cache', action='store_true', help='do not use the download cache in data/http_cache')
+    parser.add_argument('--cache-only', action='store_true', help='offline mode: only read files from the download cache')
+    parser.add_argument('--extract-ihme', action='store_true', help='also unpack every IHME archive into data/ihme_archive')
+    parser.add_argument('--reprobe', action='store_true',
+                        help='ignore the index of known missing LANL files and the IHME archive manifest, and use the date window only')
+    parser.add_argument('--load-method', choices=['upsert','copy'], default='upsert',
+                        help='upsert with pangres or bulk load with COPY and a staging table (default: upsert)')
+    parser.add_argument('--merge-memory-mb', type=int, default=512,
+                        help='approximate memory ceiling for each merge chunk in MB (default: 512)')
+    parser.add_argument('--load-workers', type=int, default=1, help='model_dates loaded concurrently, one db connection each (default: 1)')
+    parser.add_argument('--cache-max-mb', type=int, default=5120, help='download cache size cap in MB (default: 5120)')
+    parser.add_argument('--force', action='store_true', help='run every stage even if its inputs are unchanged since the last successful run')
+    parser.add_argument('--build-cube', action='store_true', help='rebuild the memory-mapped cube in data/cube for the dashboard after loading')
+    args = parser.parse_args()
+
+    min_date = str(args.min_date) #zero padded YYYY-MM-DD, compared as a string with model versions and urls
 
     if not os.path.exists('data'):
         os.mkdir('data')
 
     print('creating db engine')
     # create the covid_projections db
-    engine = create_engine(app_config['sqlalchemy_database_uri'], echo=False)
-
-    get_lanl_df(min_date)
-    get_ihme_df(min_date)
-    merge_projections()
-    create_projections_table(min_date)
+    engine = create_engine(app_config['sqlalchemy_database_uri'], echo=False, pool_size=max(5, args.load_workers))
+
+    cache = None
+    if not args.no_cache:
+        cache = DownloadCache(max_bytes=args.cache_max_mb * 1024**2, offline=args.cache_only)
+    downloader = Downloader(max_concurrency=args.max_per_host, rate_limit=args.rate_limit, cache=cache)
+
+    probe_index = None if args.reprobe else ProbeIndex()
+
+    def run_lanl():
+        rows = get_lanl_df(min_date, workers=args.workers, downloader=downloader, probe_index=probe_index, parse_workers=args.parse_workers)
+        if probe_index is not None:
+            found, missing = probe_index.counts()
+            print(f'lanl probe index: skipped {probe_index.skipped} known misses ({found} found, {missing} missing urls indexed)')
+        if cache is not None:
+            cache.save()
+        return rows
+
+    def run_ihme():
+        df = get_ihme_df(min_date, downloader=downloader, extract=args.extract_ihme, parse_workers=args.parse_workers,
+                         manifest=None if args.reprobe else IhmeManifest())
+        if cache is not None:
+            cache.save()
+            print(f'download cache: {cache.hits} hits, {cache.misses} misses, {cache.size() / 1024**2:.1f} MB')
+        return len(df) if df is not None else 0
+
+    def store_fingerprint(*names):
+        return fingerprint(*[PartitionedStore(name).fingerprint() for name in names])
+
+    #download stages run every time: files can be published at any point of the day, and the stores,
+    #probe index and ihme manifest already limit them to files not fetched yet;
+    #merge and load are keyed on the contents of the stores they read
+    pipeline = Pipeline(force=args.force)
+    pipeline.stage('lanl', run_lanl, None)
+    pipeline.stage('ihme', run_ihme, None)
+    pipeline.stage('merge', lambda: merge_projections(max_memory_mb=args.merge_memory_mb),
+                   lambda: store_fingerprint('lanl_confirmed', 'lanl_deaths', 'ihme'))
+    pipeline.stage('load', lambda: create_projections_table(method=args.load_method, workers=args.load_workers),
+                   lambda: store_fingerprint('merged'))
+    pipeline.stage('catalog', lambda: len(refresh_catalog(engine)['locations']),
+                   lambda: store_fingerprint('merged'))
+    if args.build_cube:
+        #dashboard workers started with COVID_PRED_CUBE_DIR=data/cube pick up the new generation on their own
+        def run_cube():
+            build_cube(engine, table_name=app_config['database_name'])
+        pipeline.stage('cube', run_cube, lambda: store_fingerprint('merged'))
+    pipeline.run()
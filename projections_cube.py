@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Optional dense float32 cube of the projections table for the dashboard.
+# The cube is indexed by [location, model_version, date, metric] and stored as a raw memory-mapped file,
+# laid out [location, metric, model_version, date] so that one filter_df request (one location, one metric,
+# a range of versions) reads a contiguous block. Every gunicorn worker maps the same file, so the data lives
+# once in the page cache and a request is an array slice instead of a query.
+#
+# Each build writes a new generation directory under the cube root and then atomically repoints the
+# `current` symlink at it; readers pick up the new generation on their next check and in-flight
+# requests keep using the mapping they already hold.
+#
+# usage: python projections_cube.py [--root data/cube] [--metric deaths_mean ...]
+
+import os
+import json
+import time
+import shutil
+import argparse
+import threading
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine
+
+from bulk_load import table_columns
+from catalog import numeric_columns
+from config import app_config
+from plot_option_data import table_dtypes
+from region_abbreviations import us_state_abbrev
+
+min_cube_date = pd.Timestamp('2020-02-16') #filter_df only ever asks for date > 2020-02-15
+
+def cube_columns(engine, table_name, metrics=None):
+    conn = engine.raw_connection()
+    try:
+        columns = numeric_columns(table_columns(conn.cursor(), table_name))
+    finally:
+        conn.close()
+    if metrics:
+        columns = [c for c in columns if c in metrics]
+    return columns
+
+def build_cube(engine, root=os.path.join('data', 'cube'), table_name='projections', metrics=None, keep=2, chunksize=200000):
+    '''
+    build a new cube generation from table_name and make it current
+    metrics: optional subset of metric columns, the cube size is
+        locations x metrics x versions x dates x 4 bytes
+    keep: number of generations to keep on disk (the new one included)
+    chunksize: rows read from the database at a time
+    returns: path of the new generation
+    '''
+    metrics = cube_columns(engine, table_name, metrics)
+    locations = pd.read_sql_query(f'SELECT DISTINCT location_name FROM {table_name} ORDER BY location_name', engine).location_name.tolist()
+    versions = pd.read_sql_query(
+        f'SELECT DISTINCT model_name, model_version, model_date FROM {table_name} ORDER BY model_date, model_name, model_version',
+        engine, parse_dates=['model_date'])
+    max_date = pd.read_sql_query(f'SELECT MAX(date) AS max_date FROM {table_name}', engine, parse_dates=['max_date']).max_date[0]
+    n_dates = max((pd.Timestamp(max_date) - min_cube_date).days + 1, 1)
+
+    shape = (len(locations), len(metrics), len(versions), n_dates)
+    print(f'building cube {shape} ({np.prod(shape) * 4 / 1024**2:.0f} MB)')
+
+    os.makedirs(root, exist_ok=True)
+    generation = datetime.utcnow().strftime('cube-%Y%m%dT%H%M%S_%f')
+    path = os.path.join(root, generation)
+    os.mkdir(path)
+
+    values = np.memmap(os.path.join(path, 'values.f32'), dtype='<f4', mode='w+', shape=shape)
+    for li in range(len(locations)):
+        values[li] = np.nan #one location at a time to keep memory flat
+
+    location_codes = {name: i for i, name in enumerate(locations)}
+    version_codes = {(n, v): i for i, (n, v) in enumerate(zip(versions.model_name, versions.model_version))}
+    col_list = ', '.join(f'"{c}"' for c in metrics)
+    rows = 0
+
+    #stream the table once with a server-side cursor, chunksize rows at a time, so memory stays flat
+    #(a per model_date query would scan the whole table for every version unless it is partitioned);
+    #rows are written by computed index, so they are read unordered and postgres does not have to sort
+    query = (f"SELECT location_name, date, model_name, model_version, {col_list} FROM {table_name} "
+             f"WHERE date >= %s")
+    with engine.connect() as conn:
+        chunks = pd.read_sql_query(query, conn.execution_options(stream_results=True), params=(min_cube_date.to_pydatetime(),),
+                                   parse_dates=['date'], chunksize=chunksize)
+        for df in chunks:
+            df = df.astype(dict((k, table_dtypes[k]) for k in metrics if k in table_dtypes))
+
+            li = df.location_name.map(location_codes).to_numpy()
+            vi = np.array([version_codes[k] for k in zip(df.model_name, df.model_version)], dtype=np.int64)
+            di = ((df.date - min_cube_date) // pd.Timedelta(days=1)).to_numpy()
+            for mi, metric in enumerate(metrics):
+                values[li, mi, vi, di] = df[metric].to_numpy(dtype='<f4')
+            rows += len(df)
+
+    values.flush()
+    del values
+
+    index = {
+        'shape': shape,
+        'dtype': '<f4',
+        'layout': ['location', 'metric', 'model_version', 'date'],
+        'locations': locations,
+        'location_abbr': [us_state_abbrev.get(name) for name in locations],
+        'metrics': metrics,
+        'model_name': versions.model_name.astype('str').tolist(),
+        'model_version': versions.model_version.astype('str').tolist(),
+        'model_date': versions.model_date.dt.strftime('%Y-%m-%d').tolist(),
+        'first_date': str(min_cube_date.date()),
+        'rows': rows,
+    }
+    with open(os.path.join(path, 'index.json'), 'w') as f:
+        json.dump(index, f)
+
+    #atomic swap: readers follow the symlink, which is replaced in one rename
+    tmp_link = os.path.join(root, f'current.{os.getpid()}.tmp')
+    os.symlink(generation, tmp_link)
+    os.replace(tmp_link, os.path.join(root, 'current'))
+    print(f'cube {generation}: {rows} rows')
+
+    #older generations can be removed while mapped, the mapping keeps the file alive until readers swap
+    generations = sorted(d for d in os.listdir(root) if d.startswith('cube-'))
+    for old in generations[:-keep]:
+        shutil.rmtree(os.path.join(root, old), ignore_errors=True)
+
+    return path
+
+
+class ProjectionsCube:
+    '''
+    read-only view of one cube generation
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'index.json')) as f:
+            index = json.load(f)
+        self.values = np.memmap(os.path.join(path, 'values.f32'), dtype=index['dtype'], mode='r', shape=tuple(index['shape']))
+        self.locations = {name: i for i, name in enumerate(index['locations'])}
+        self.location_abbr = index['location_abbr']
+        self.metrics = {name: i for i, name in enumerate(index['metrics'])}
+        self.versions = pd.DataFrame({
+            'model_name': index['model_name'],
+            'model_version': index['model_version'],
+            'model_date': pd.to_datetime(index['model_date']),
+        })
+        self.dates = pd.date_range(index['first_date'], periods=index['shape'][3])
+
+    def __contains__(self, metric):
+        return metric in self.metrics
+
+    def filter_df(self, model, location, metric, start_date, end_date):
+        '''
+        the rows load_filter_df would query: one location and metric, versions of the given models
+        with model_date between start_date and end_date, missing values dropped
+        returns: frame with location_name, date, metric, model_name, model_date, model_version, location_abbr
+        '''
+        columns = ['location_name', 'date', metric, 'model_name', 'model_date', 'model_version', 'location_abbr']
+        li, mi = self.locations.get(location), self.metrics.get(metric)
+        versions = self.versions[
+            self.versions.model_name.isin(model) &
+            (self.versions.model_date >= pd.Timestamp(start_date)) &
+            (self.versions.model_date <= pd.Timestamp(end_date))
+        ]
+        if li is None or mi is None or versions.empty:
+            return pd.DataFrame(columns=columns)
+
+        block = self.values[li, mi][versions.index.to_numpy()] #(versions, dates) copy of just this slice
+        vi, di = np.nonzero(~np.isnan(block))
+        version_rows = versions.iloc[vi]
+
+        return pd.DataFrame({
+            'location_name': location,
+            'date': self.dates[di],
+            metric: block[vi, di],
+            'model_name': version_rows.model_name.to_numpy(),
+            'model_date': version_rows.model_date.to_numpy(),
+            'model_version': version_rows.model_version.to_numpy(),
+            'location_abbr': self.location_abbr[li],
+        }, columns=columns).sort_values('date', kind='mergesort')
+
+
+class CubeReader:
+    '''
+    follows the `current` symlink of a cube root, reopening the cube when a new generation is swapped in
+    check_interval: seconds between symlink checks
+    '''
+
+    def __init__(self, root, check_interval=30):
+        self.root = root
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._cube = None
+        self._generation = None
+        self._checked_at = 0.0
+
+    def generation(self):
+        '''
+        name of the current generation, None if no cube has been built
+        '''
+        self.current()
+        return self._generation
+
+    def current(self):
+        '''
+        returns: the current ProjectionsCube, or None if no cube has been built
+        '''
+        with self._lock:
+            now = time.time()
+            if now - self._checked_at >= self.check_interval:
+                self._checked_at = now
+                try:
+                    generation = os.readlink(os.path.join(self.root, 'current'))
+                except OSError:
+                    generation = None
+                if generation != self._generation:
+                    self._cube = ProjectionsCube(os.path.join(self.root, generation)) if generation else None
+                    self._generation = generation
+                    print(f'serving projections from cube {generation}')
+            return self._cube
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='build the memory-mapped projections cube for the dashboard')
+    parser.add_argument('--root', default=os.path.join('data', 'cube'), help='cube directory (default: data/cube)')
+    parser.add_argument('--metric', action='append', default=[], help='only include this metric (repeatable, default: all)')
+    parser.add_argument('--keep', type=int, default=2, help='generations kept on disk (default: 2)')
+    args = parser.parse_args()
+
+    engine = create_engine(app_config['sqlalchemy_database_uri'])
+    build_cube(engine, root=args.root, table_name=app_config['database_name'], metrics=args.metric, keep=args.keep)
@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# SQL used by the dashboard, shared with the migration tool and the query plan benchmark
+# so the index is tuned to (and benchmarked against) the exact query the app runs
+
+from helper import flatten
+
+def filter_query(table_name, metric, n_models):
+    '''
+    query behind filter_df: one location, a set of models and a model_date range
+    params: see filter_params()
+    '''
+    filter_query = '''
+    SELECT location_name, date, {3}, model_name, model_date, model_version, location_abbr
+    FROM {0}
+    WHERE {0}.location_name = {1}
+    AND {0}.model_name IN ({2})
+    AND {0}.model_date BETWEEN {1}
+    AND {1} AND {0}.date > '2020-02-15'
+    ORDER BY {0}.date
+    '''
+    return filter_query.format(table_name, '%s', ','.join(['%s'] * n_models), metric)
+
+def filter_params(model, location, start_date, end_date):
+    return tuple(flatten((location, model, start_date, end_date)))
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Declarative schemas for the raw LANL and IHME files.
+# Built from plot_option_data.csv_dtypes (what ends up in the projections table) and
+# lanl_to_ihme_translator (which LANL columns feed it), so parsers only materialize the
+# columns we load, already in their final dtype.
+
+import io
+
+import pandas as pd
+
+from plot_option_data import csv_dtypes
+from column_translater import lanl_to_ihme_translator
+
+
+class SourceSchema:
+    '''
+    columns: canonical column name -> dtype
+    aliases: source column name -> canonical name, for columns renamed between model versions
+    ignored: source columns we know about and deliberately skip (not reported as unknown)
+    required: canonical columns that must be present for the file to be usable
+    '''
+
+    def __init__(self, name, columns, aliases=None, ignored=None, required=None):
+        self.name = name
+        self.columns = columns
+        self.aliases = aliases or {}
+        self.ignored = set(ignored or [])
+        self.required = required or []
+
+    def canonical(self, col):
+        return self.aliases.get(col, col)
+
+    def usecols(self, header):
+        '''
+        returns: source columns from header that map to a schema column
+        '''
+        return [c for c in header if self.canonical(c) in self.columns]
+
+    def report(self, header, source=''):
+        '''
+        print and return the source columns the schema does not know and the schema columns
+        missing from the source
+        returns: (unknown, missing)
+        '''
+        present = {self.canonical(c) for c in header}
+        unknown = [c for c in header if self.canonical(c) not in self.columns and c not in self.ignored]
+        missing = [c for c in self.columns if c not in present]
+        if unknown:
+            print(f'{self.name} schema: unknown columns in {source}: {unknown}')
+        if missing:
+            print(f'{self.name} schema: missing columns in {source}: {missing}')
+        return unknown, missing
+
+    def read_csv(self, open_file, source=''):
+        '''
+        parse only the schema columns of a csv, renamed to their canonical names
+        open_file: callable returning a fresh file object for the csv (the header is read first)
+        returns: dataframe
+        '''
+        with open_file() as f:
+            header = list(pd.read_csv(f, nrows=0).columns)
+        self.report(header, source)
+
+        missing_required = [c for c in self.required if c not in {self.canonical(h) for h in header}]
+        if missing_required:
+            raise ValueError(f'{self.name} schema: {source} has no {missing_required} column')
+
+        usecols = self.usecols(header)
+        dtype = {c: self.columns[self.canonical(c)] for c in usecols if self.columns[self.canonical(c)] is not None}
+        with open_file() as f:
+            df = pd.read_csv(f, usecols=usecols, dtype=dtype)
+
+        return df.rename(columns=self.aliases)[[self.canonical(c) for c in usecols]]
+
+
+#LANL: cumulative quantiles referenced by lanl_to_ihme_translator, kept as float64 since they are differenced later
+lanl_quantiles = sorted({k.split('_')[1] for k in lanl_to_ihme_translator if k.startswith(('deaths_q', 'confirmed_q'))})
+
+lanl_schema = SourceSchema(
+    'lanl',
+    columns=dict(
+        [('dates', None), ('location_name', 'category'), ('fcst_date', None)] +
+        [(f'q.{q[1:]}', 'float64') for q in lanl_quantiles]
+    ),
+    #columns renamed between model versions
+    aliases={'state': 'location_name', 'countries': 'location_name', 'name': 'location_name', 'date': 'dates'},
+    ignored=[
+        'simple_state', 'simple_countries', 'key', 'big_group', 'truth_confirmed', 'obs',
+        'q.01', 'q.025', 'q.10', 'q.15', 'q.20', 'q.25', 'q.30', 'q.35', 'q.40', 'q.45',
+        'q.55', 'q.60', 'q.65', 'q.70', 'q.75', 'q.80', 'q.85', 'q.90', 'q.975', 'q.99',
+    ],
+    required=['dates', 'location_name', 'fcst_date'],
+)
+
+#IHME: csv_dtypes columns that come from IHME (not LANL-derived and not added by the merge)
+lanl_only_columns = {v for k, v in lanl_to_ihme_translator.items() if k.startswith('confirmed_')} #case counts only LANL provides
+
+#columns IHME has added over time that we do not load
+ihme_ignored_columns = [
+    'V1', 'Unnamed: 0', 'location', 'location_id',
+    'mobility_data_type', 'total_tests_data_type',
+    'mobility_composite','total_tests','confirmed_infections',
+    'est_infections_mean','est_infections_lower','est_infections_upper',
+    'deaths_mean_smoothed','deaths_lower_smoothed','deaths_upper_smoothed',
+    'totdea_mean_smoothed','totdea_lower_smoothed','totdea_upper_smoothed',
+    #more new columns
+    'total_pop', 
+    'deaths_mean_p100k_rate', 'deaths_lower_p100k_rate', 'deaths_upper_p100k_rate', 
+    'totdea_mean_p100k_rate', 'totdea_lower_p100k_rate', 'totdea_upper_p100k_rate', 
+    'deaths_mean_smoothed_p100k_rate', 'deaths_lower_smoothed_p100k_rate', 'deaths_upper_smoothed_p100k_rate', 
+    'totdea_mean_smoothed_p100k_rate', 'totdea_lower_smoothed_p100k_rate', 'totdea_upper_smoothed_p100k_rate', 
+    'confirmed_infections_p100k_rate', 'est_infections_mean_p100k_rate', 'est_infections_lower_p100k_rate', 
+    'est_infections_upper_p100k_rate', 
+    'inf_cuml_mean', 'inf_cuml_lower', 'inf_cuml_upper', 
+    'sero_pct', 'sero_pctlower', 'sero_pctupper', #column names may have changed for seroprevalence
+    'seroprev_mean', 'seroprev_upper', 'seroprev_lower',
+    #even more new columns
+    'deaths_data_type', 'confirmed_infections_data_type', 'est_infections_data_type', 
+    'seroprev_data_type', 
+    'observed' #this column may have been added then removed
+]
+
+ihme_schema = SourceSchema(
+    'ihme',
+    columns={
+        c: (None if c == 'date' else dtype)
+        for c, dtype in csv_dtypes.items()
+        if c not in lanl_only_columns and c not in ('model_version', 'model_name') and c not in ihme_ignored_columns
+    },
+    aliases={'date_reported': 'date'},
+    ignored=ihme_ignored_columns,
+    required=['location_name', 'date'],
+)
+
+def bytes_opener(content):
+    '''
+    returns: callable giving a fresh text stream over downloaded bytes, for SourceSchema.read_csv
+    '''
+    text = content.decode('utf8')
+    return lambda: io.StringIO(text)
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Tests for cumulative.grouped_diff: group boundaries and the first row of every group
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+from cumulative import grouped_diff
+
+def lanl_frame():
+    #two forecasts x two locations, rows shuffled so grouped_diff has to sort
+    df = pd.DataFrame({
+        'fcst_date': ['2020-05-01'] * 3 + ['2020-05-01'] * 3 + ['2020-05-04'] * 2,
+        'location_name': ['Alabama'] * 3 + ['Alaska'] * 3 + ['Alabama'] * 2,
+        'dates': pd.to_datetime(['2020-05-02', '2020-05-03', '2020-05-04'] * 2 + ['2020-05-05', '2020-05-06']),
+        'q50': [1000, 1010, 1025, 20, 21, 25, 1100, 1130],
+    })
+    return df.sample(frac=1, random_state=0)
+
+def test_first_row_of_each_group_is_missing():
+    df = grouped_diff(lanl_frame(), ['fcst_date', 'location_name'], 'dates', ['q50'])
+    diffs = {k: g['q50_diff'].tolist() for k, g in df.groupby(['fcst_date', 'location_name'])}
+
+    for values in diffs.values():
+        assert np.isnan(values[0])
+    assert diffs[('2020-05-01', 'Alabama')][1:] == [10, 15]
+    assert diffs[('2020-05-01', 'Alaska')][1:] == [1, 4]
+    assert diffs[('2020-05-04', 'Alabama')][1:] == [30]
+
+def test_no_leak_across_group_boundaries():
+    df = grouped_diff(lanl_frame(), ['fcst_date', 'location_name'], 'dates', ['q50'])
+    #a diff crossing from one group into the next would be negative here
+    assert (df['q50_diff'].dropna() >= 0).all()
+
+def test_categorical_keys():
+    df = lanl_frame().astype({'location_name': 'category'})
+    df = grouped_diff(df, ['fcst_date', 'location_name'], 'dates', ['q50'])
+    assert df['q50_diff'].isna().sum() == 3
+
+def test_first_value():
+    df = grouped_diff(lanl_frame(), ['fcst_date', 'location_name'], 'dates', ['q50'], first='value')
+    firsts = df.groupby(['fcst_date', 'location_name'])['q50_diff'].first().tolist()
+    assert sorted(firsts) == [20, 1000, 1100]